@@ -0,0 +1,473 @@
+"""Synthetic load generator and benchmark for the chat storage and render paths of gc6.py
+
+Each storage backend runs in its own process against a fresh temporary database, so latencies and peak memory
+are measured independently. The chat file encodings are also compared on the same synthetic messages, and the
+chat file layouts on a given number of users (--layout-users):
+
+    python bench_chat.py --users 100 --history 200 --sessions 8 --duration 15 --output bench.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then not reported
+    resource = None
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "gc6.py")
+
+# Relative weights of the operations each simulated session performs in the mixed phase
+OPERATION_MIX = {
+    "save_private_chat_message": 4,
+    "load_private_chat": 3,
+    "get_all_user_chats": 1,
+    "mark_messages_as_read": 1,
+    "display_media_message": 2
+}
+
+
+class Recorder:
+    """Thread-safe collection of latency samples per operation"""
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds):
+        with self._lock:
+            self._samples.setdefault(operation, []).append(seconds)
+
+    def time(self, operation, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.record(operation, time.perf_counter() - start)
+        return result
+
+    def summary(self, elapsed):
+        """Return count, throughput and latency percentiles in milliseconds for every operation"""
+        with self._lock:
+            return {operation: summarize(samples, elapsed) for operation, samples in sorted(self._samples.items())}
+
+
+def percentile(sorted_samples, fraction):
+    """Return the nearest-rank percentile of already sorted samples"""
+    index = max(int(round(fraction * len(sorted_samples) + 0.5)) - 1, 0)
+    return sorted_samples[min(index, len(sorted_samples) - 1)]
+
+
+def summarize(samples, elapsed):
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "throughput_per_s": round(len(ordered) / elapsed, 2) if elapsed else None,
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3)
+    }
+
+
+def peak_rss_mb():
+    """Return the peak resident memory of this process in MB, or None where it cannot be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def upload_file(name, data):
+    """Wrap bytes like a Streamlit UploadedFile"""
+    uploaded_file = io.BytesIO(data)
+    uploaded_file.name = name
+    uploaded_file.size = len(data)
+    return uploaded_file
+
+
+def make_media_pool(gc6, args, rng):
+    """Upload and process a pool of distinct media files, returning the message fields for each"""
+    from PIL import Image
+
+    pool = []
+    for i in range(args.media_files):
+        if rng.random() < args.video_ratio:
+            name = f"clip{i}.mp4"
+            data = b"\x00\x00\x00\x18ftypmp42" + rng.randbytes(args.video_kb * 1024)
+        else:
+            name = f"photo{i}.png"
+            image = Image.new("RGB", (args.image_size, args.image_size * 3 // 4),
+                              tuple(rng.randrange(256) for _ in range(3)))
+            buffer = io.BytesIO()
+            image.save(buffer, "PNG")
+            data = buffer.getvalue()
+
+        upload = gc6.ingest_upload(upload_file(name, data))
+        if upload["error"]:
+            raise RuntimeError(upload["error"])
+        fields = {
+            "media_path": gc6.commit_upload(upload),
+            "media_type": upload["media_type"],
+            "media_sha256": upload["sha256"],
+            "media_status": "ready",
+            "original_filename": name
+        }
+        if upload["media_type"] == "image":
+            fields.update(gc6.process_image(fields["media_path"], upload["sha256"]))
+        pool.append(fields)
+    return pool
+
+
+def make_message(gc6, user_id, sender, media_pool, args, rng):
+    message = {
+        "message_id": str(gc6.uuid4()),
+        "content": f"benchmark message {rng.randrange(10 ** 6)} " * rng.randint(1, 8),
+        "timestamp": gc6.format_message_time(),
+        "sender": sender
+    }
+    if media_pool and rng.random() < args.media_ratio:
+        message.update(rng.choice(media_pool))
+    return message
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def seed_phase(gc6, users, media_pool, args):
+    """Write each user's history through the app's save path, from several sessions at once"""
+    recorder = Recorder()
+
+    def session(index):
+        rng = random.Random(args.seed + index)
+        for user_id in users[index::args.sessions]:
+            for i in range(args.history):
+                sender = "admin" if i % 3 == 2 else user_id
+                message = make_message(gc6, user_id, sender, media_pool, args, rng)
+                if not recorder.time("save_private_chat_message", gc6.save_private_chat_message, user_id, message):
+                    raise RuntimeError(f"Failed to save a message for {user_id}")
+
+    start = time.perf_counter()
+    run_threads(args.sessions, session)
+    return recorder.summary(time.perf_counter() - start)
+
+
+def mixed_phase(gc6, users, media_pool, args):
+    """Run a weighted mix of reads, writes and renders from concurrent sessions, paced to the target rate"""
+    recorder = Recorder()
+    operations, weights = zip(*OPERATION_MIX.items())
+    media_messages = [{"message_id": str(i), "sender": "admin", "content": "", **fields}
+                      for i, fields in enumerate(media_pool)]
+    interval = args.sessions / args.rate if args.rate else 0
+    deadline = time.perf_counter() + args.duration
+
+    def session(index):
+        rng = random.Random(args.seed * 31 + index)
+        next_at = time.perf_counter()
+        while time.perf_counter() < deadline:
+            if interval:
+                time.sleep(max(next_at - time.perf_counter(), 0))
+                next_at += interval
+
+            operation = rng.choices(operations, weights)[0]
+            user_id = rng.choice(users)
+            if operation == "save_private_chat_message":
+                sender = "admin" if rng.random() < 0.5 else user_id
+                message = make_message(gc6, user_id, sender, media_pool, args, rng)
+                recorder.time(operation, gc6.save_private_chat_message, user_id, message)
+            elif operation == "load_private_chat":
+                recorder.time(operation, gc6.load_private_chat, user_id)
+            elif operation == "get_all_user_chats":
+                recorder.time(operation, gc6.get_all_user_chats)
+            elif operation == "mark_messages_as_read":
+                recorder.time(operation, gc6.mark_messages_as_read, user_id)
+            elif media_messages:
+                recorder.time(operation, gc6.display_media_message, rng.choice(media_messages), False)
+
+    start = time.perf_counter()
+    run_threads(args.sessions, session)
+    return recorder.summary(time.perf_counter() - start)
+
+
+def sign_in(app, username, is_admin):
+    """Start an AppTest session already signed in, with auto-refresh off so each run returns"""
+    for key, value in {"current_user": username, "is_authenticated": True, "is_admin": is_admin,
+                       "auto_refresh_enabled": False}.items():
+        app.session_state[key] = value
+
+
+def ui_phase(args):
+    """Drive the full app headlessly: the login page, admin inbox reruns, opening a chat and replying
+
+    User chat views are left out, since they always wait for new messages and so a run never finishes.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    recorder = Recorder()
+    start = time.perf_counter()
+
+    def run(operation, app):
+        recorder.time(operation, app.run)
+        if app.exception:
+            raise RuntimeError(f"{operation} failed: {app.exception[0].value}")
+
+    for _ in range(args.ui_runs):
+        run("ui_login_page", AppTest.from_file(APP_PATH, default_timeout=60))
+
+        # Signed in through session state, since the login form pauses to show its welcome message
+        admin = AppTest.from_file(APP_PATH, default_timeout=60)
+        sign_in(admin, "Ariyan", is_admin=True)
+        run("ui_inbox", admin)
+        run("ui_inbox_rerun", admin)
+        open_buttons = [button for button in admin.button if button.label == "💬 Open"]
+        if open_buttons:
+            open_buttons[0].click()
+            run("ui_open_chat", admin)
+            run("ui_chat_rerun", admin)
+            admin.chat_input[0].set_value("benchmark reply")
+            run("ui_send_reply", admin)
+
+    return recorder.summary(time.perf_counter() - start)
+
+
+def run_worker(args):
+    """Benchmark the backend this process was configured for and write the results as JSON"""
+    logging.disable(logging.WARNING)
+    sys.path.insert(0, APP_DIR)
+    import gc6
+
+    rng = random.Random(args.seed)
+    users = [f"bench_user_{i:05d}" for i in range(args.users)]
+    media_pool = make_media_pool(gc6, args, rng) if args.media_ratio > 0 else []
+
+    phases = {"seed": seed_phase(gc6, users, media_pool, args), "mixed": mixed_phase(gc6, users, media_pool, args)}
+    if args.ui_runs:
+        phases["ui"] = ui_phase(args)
+
+    result = {"backend": gc6.CHAT_STORE_BACKEND, "phases": phases, "peak_rss_mb": peak_rss_mb()}
+    with open(args.result, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+def time_per_item(func, items):
+    """Return the mean time of func over the items in microseconds, taking the best of three passes"""
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / len(items) * 1e6, 3)
+
+
+def codec_benchmark(args):
+    """Compare the size, encode and decode time per message of the chat file formats on the same messages"""
+    sys.path.insert(0, APP_DIR)
+    import gc6
+
+    rng = random.Random(args.seed)
+    media_pool = [{
+        "media_path": f"database/media/{sha[:2]}/{sha}.jpg",
+        "media_type": "image",
+        "media_sha256": sha,
+        "media_status": "ready",
+        "original_filename": f"photo{i}.jpg",
+        "media_width": 1600,
+        "media_height": 1200,
+        "thumbnails": {str(size): f"database/thumbnails/{sha}_{size}.webp" for size in gc6.THUMBNAIL_WIDTHS}
+    } for i, sha in enumerate(f"{rng.getrandbits(256):064x}" for _ in range(args.media_files or 1))]
+    messages = [make_message(gc6, "bench_user", "bench_user" if i % 2 else "admin", media_pool, args, rng)
+                for i in range(args.codec_messages)]
+    at = "2024-01-01T12:00:00.000000"
+
+    def log_v2_line(item):
+        seq, message = item
+        return json.dumps({"op": "message", "seq": seq, "at": at, "message": message})
+
+    def log_v3_line(item, dumps):
+        seq, message = item
+        return dumps({"op": "message", "seq": seq, "at": at, "message": gc6.encode_message(message)})
+
+    stdlib_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+    codecs = {
+        "log_v2": (log_v2_line, lambda line: dict(json.loads(line)["message"])),
+        "log_v3_stdlib": (lambda item: log_v3_line(item, stdlib_encoder.encode),
+                          lambda line: gc6.decode_message(json.loads(line)["message"])),
+        "log_v3_orjson": (lambda item: log_v3_line(item, gc6.json_dumps),
+                          lambda line: gc6.decode_message(gc6.json_loads(line)["message"]))
+    }
+
+    items = list(enumerate(messages, start=1))
+    # Legacy chats were one indented document per chat, rewritten on every message
+    legacy = json.dumps({"messages": messages}, indent=2)
+    results = {"legacy_json": {
+        "bytes_per_message": round(len(legacy.encode()) / len(messages), 1),
+        "dump_us": time_per_item(lambda _: json.dumps({"messages": messages}, indent=2), [None]) / len(messages),
+        "parse_us": time_per_item(json.loads, [legacy]) / len(messages)
+    }}
+    for name, (dump, parse) in codecs.items():
+        lines = [dump(item) for item in items]
+        results[name] = {
+            "bytes_per_message": round(sum(len(line.encode()) + 1 for line in lines) / len(lines), 1),
+            "dump_us": time_per_item(dump, items),
+            "parse_us": time_per_item(parse, lines)
+        }
+    for result in results.values():
+        result["dump_us"] = round(result["dump_us"], 3)
+        result["parse_us"] = round(result["parse_us"], 3)
+    return {"messages": len(messages), "codecs": results}
+
+
+def layout_benchmark(args):
+    """Compare creating, looking up and listing chat logs in the flat layout and in shard directories"""
+    sys.path.insert(0, APP_DIR)
+    import gc6
+
+    rng = random.Random(args.seed)
+    user_ids = [f"user_{i}" for i in range(args.layout_users)]
+    present = rng.sample(user_ids, min(len(user_ids), 2000))
+    missing = [f"nobody_{i}" for i in range(len(present))]
+
+    results = {}
+    for depth in (0, 1, 2):
+        name = "flat" if depth == 0 else f"sharded_{depth}"
+        root = tempfile.mkdtemp(prefix=f"bench_layout_{name}_")
+
+        def chat_path(user_id):
+            return f"{root}/{user_id}.jsonl" if depth == 0 else f"{root}/{gc6._chat_shard(user_id, depth)}.jsonl"
+
+        def list_chats():
+            return sum(1 for _, _, filenames in os.walk(root) for filename in filenames if filename.endswith(".jsonl"))
+
+        try:
+            start = time.perf_counter()
+            for user_id in user_ids:
+                path = chat_path(user_id)
+                if depth:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                header = {"op": "header", "user_id": user_id, "version": gc6.CHAT_LOG_VERSION}
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(gc6.json_dumps(header) + "\n")
+            create_seconds = time.perf_counter() - start
+
+            def read_header(user_id):
+                with open(chat_path(user_id), "rb") as f:
+                    return f.readline()
+
+            results[name] = {
+                "create_us": round(create_seconds / len(user_ids) * 1e6, 3),
+                "lookup_us": time_per_item(read_header, present),
+                "missing_us": time_per_item(lambda user_id: os.path.exists(chat_path(user_id)), missing),
+                "list_ms": round(time_per_item(lambda _: list_chats(), [None]) / 1000, 1),
+                "largest_directory": max(len(filenames) + len(dirnames) for _, dirnames, filenames in os.walk(root))
+            }
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+    return {"users": len(user_ids), "layouts": results}
+
+
+def run_backend(backend, args):
+    """Run one backend's benchmark in a fresh process and directory, returning its results"""
+    workdir = tempfile.mkdtemp(prefix=f"bench_{backend}_")
+    result_path = os.path.join(workdir, "result.json")
+    env = dict(os.environ, CHAT_STORE_BACKEND=backend, CHAT_FSYNC="1" if args.fsync else "0",
+               MEDIA_GC_INTERVAL="0", CHAT_ARCHIVE_INTERVAL="0", MEDIA_SERVER_PORT=str(free_port()))
+    env.pop("CHAT_DB_PATH", None)
+    env.pop("CHAT_INDEX_DB_PATH", None)
+    env.pop("CHAT_ARCHIVE_DIR", None)
+
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--result", result_path]
+    command += args.argv
+    try:
+        subprocess.run(command, cwd=workdir, env=env, check=True)
+        with open(result_path, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        if args.keep:
+            print(f"Kept {backend} data in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default="json,sqlite", help="comma-separated storage backends to compare")
+    parser.add_argument("--users", type=int, default=50, help="number of user chats")
+    parser.add_argument("--history", type=int, default=100, help="messages seeded into each chat")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent simulated sessions")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run the mixed workload")
+    parser.add_argument("--rate", type=float, default=0, help="target operations per second (0 for unthrottled)")
+    parser.add_argument("--media-ratio", type=float, default=0.1, help="fraction of messages carrying media")
+    parser.add_argument("--video-ratio", type=float, default=0.2, help="fraction of media files that are videos")
+    parser.add_argument("--media-files", type=int, default=20, help="distinct media files shared by messages")
+    parser.add_argument("--image-size", type=int, default=1600, help="width of generated images in pixels")
+    parser.add_argument("--video-kb", type=int, default=512, help="size of generated videos in KB")
+    parser.add_argument("--codec-messages", type=int, default=20000,
+                        help="messages to compare chat file encodings on (0 to skip)")
+    parser.add_argument("--layout-users", type=int, default=0,
+                        help="chats to compare the flat and sharded file layouts on, e.g. 100000 (0 to skip)")
+    parser.add_argument("--ui-runs", type=int, default=3, help="headless UI walkthroughs per backend (0 to skip)")
+    parser.add_argument("--no-fsync", dest="fsync", action="store_false", help="skip fsync on chat writes")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--output", help="write the JSON results here instead of to stdout")
+    parser.add_argument("--keep", action="store_true", help="keep each backend's benchmark data")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Workers are started with the same options
+    args.argv = list(sys.argv[1:] if argv is None else argv)
+    if args.worker:
+        run_worker(args)
+        return
+
+    config = {key: value for key, value in vars(args).items() if key not in ("worker", "result", "output", "keep", "argv")}
+    report = {
+        "config": config,
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "backends": {backend: run_backend(backend, args) for backend in args.backends.split(",")}
+    }
+    if args.codec_messages:
+        report["codec"] = codec_benchmark(args)
+    if args.layout_users:
+        report["layout"] = layout_benchmark(args)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Inspect and migrate the JSON chat files of gc6.py
+
+    python chat_tools.py inspect [--root DIR] [--json] [USER ...]
+    python chat_tools.py migrate [--root DIR] [--dry-run] [USER ...]
+    python chat_tools.py archive [--root DIR] [--archive-dir DIR] [USER ...]
+
+Migrating moves chats from the flat layout ({user}.json and {user}.jsonl directly under the root) into their
+hashed shard directories, converts legacy {user}.json files into logs, and rewrites logs in the current format with
+their read and update records folded in. Archiving moves the oldest messages of long chats into compressed segments
+and deletes segments past their retention, as the app does in the background. Chats are locked while they are
+rewritten, so the app can keep running.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+logging.disable(logging.WARNING)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gc6
+
+
+def chat_users(store, users):
+    """Return the users to work on: those given, or everyone with a chat file under the store's root"""
+    if users:
+        return sorted(users)
+    if not os.path.exists(store.root):
+        return []
+    flat_users = {os.path.splitext(entry.name)[0] for entry in os.scandir(store.root)
+                  if entry.is_file() and entry.name.endswith((".json", ".jsonl"))}
+    return sorted(flat_users | {user_id for user_id, _ in store.chat_files()})
+
+
+def inspect_legacy_chat(path):
+    with open(path, "r", encoding="utf-8") as f:
+        chat_data = json.load(f)
+    messages = chat_data.get("messages", [])
+    report = {"format": "legacy json", "version": None, "bytes": os.path.getsize(path), "messages": len(messages),
+              "object_messages": len(messages), "array_messages": 0, "folded_records": 0, "torn_lines": 0,
+              "invalid_messages": 0}
+    for message in messages:
+        try:
+            gc6.validate_message(message)
+        except (TypeError, AttributeError):
+            report["invalid_messages"] += 1
+    return report
+
+
+def inspect_log(path):
+    report = {"format": "log", "version": 1, "bytes": os.path.getsize(path), "messages": 0, "object_messages": 0,
+              "array_messages": 0, "folded_records": 0, "torn_lines": 0, "invalid_messages": 0}
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = gc6._parse_record(line)
+            if record is None:
+                report["torn_lines"] += 1
+            elif record.get("op") == "header":
+                report["version"] = record.get("version", 1)
+            elif record.get("op") in ("read", "update"):
+                report["folded_records"] += 1
+            elif record.get("op") == "message":
+                report["messages"] += 1
+                stored = record.get("message")
+                report["object_messages" if isinstance(stored, dict) else "array_messages"] += 1
+                try:
+                    gc6.validate_message(gc6.decode_message(stored))
+                except (TypeError, ValueError, AttributeError, IndexError):
+                    report["invalid_messages"] += 1
+    return report
+
+
+def inspect_chat(store, user_id):
+    """Describe how one user's chat is stored, or return None when it has no chat file"""
+    if os.path.exists(store.chat_path(user_id)):
+        return {"user_id": user_id, "layout": "sharded", **inspect_log(store.chat_path(user_id))}
+    if not gc6._is_plain_filename(user_id):
+        return None
+    if os.path.exists(f"{store.root}/{user_id}.jsonl"):
+        return {"user_id": user_id, "layout": "flat", **inspect_log(f"{store.root}/{user_id}.jsonl")}
+    if os.path.exists(f"{store.root}/{user_id}.json"):
+        return {"user_id": user_id, "layout": "flat", **inspect_legacy_chat(f"{store.root}/{user_id}.json")}
+    return None
+
+
+def needs_migration(report):
+    return (report["layout"] != "sharded" or report["format"] != "log" or report["version"] < gc6.CHAT_LOG_VERSION
+            or report["object_messages"] > 0 or report["folded_records"] > 0 or report["torn_lines"] > 0)
+
+
+def inspect(args):
+    store = gc6.JsonChatStore(args.root)
+    reports = [report for report in (inspect_chat(store, user_id) for user_id in chat_users(store, args.users))
+               if report is not None]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+
+    print(f"{'user':<24} {'layout':<8} {'format':<12} {'bytes':>10} {'messages':>9} {'objects':>8} {'folded':>7} "
+          f"{'torn':>5} {'invalid':>8}")
+    for report in reports:
+        version = report["format"] if report["version"] is None else f"log v{report['version']}"
+        print(f"{report['user_id']:<24} {report['layout']:<8} {version:<12} {report['bytes']:>10} "
+              f"{report['messages']:>9} {report['object_messages']:>8} {report['folded_records']:>7} "
+              f"{report['torn_lines']:>5} {report['invalid_messages']:>8}")
+    stale = sum(1 for report in reports if needs_migration(report))
+    print(f"\n{len(reports)} chats, {sum(report['bytes'] for report in reports)} bytes, "
+          f"{stale} to migrate to sharded log v{gc6.CHAT_LOG_VERSION}")
+
+
+def migrate(args):
+    store = gc6.JsonChatStore(args.root)
+    migrated = bytes_before = bytes_after = 0
+    for user_id in chat_users(store, args.users):
+        report = inspect_chat(store, user_id)
+        if report is None or not needs_migration(report):
+            continue
+        if report["invalid_messages"]:
+            print(f"{user_id}: skipped, {report['invalid_messages']} messages do not match the schema")
+            continue
+        if args.dry_run:
+            print(f"{user_id}: would migrate {report['layout']} {report['format']} ({report['bytes']} bytes)")
+            continue
+
+        store.migrate_flat_chat(user_id)
+        store.compact_log(user_id)
+        after = os.path.getsize(store.chat_path(user_id))
+        print(f"{user_id}: {report['bytes']} -> {after} bytes")
+        migrated += 1
+        bytes_before += report["bytes"]
+        bytes_after += after
+
+    if not args.dry_run:
+        print(f"\nMigrated {migrated} chats: {bytes_before} -> {bytes_after} bytes")
+
+
+def archive(args):
+    store = gc6.JsonChatStore(args.root, archive_dir=args.archive_dir)
+    archived = 0
+    for user_id in chat_users(store, args.users):
+        count = store.archive_chat(user_id)
+        if count:
+            stats = store.archive_stats(user_id)
+            print(f"{user_id}: archived {count} messages, {stats['messages']} in {stats['segments']} segments "
+                  f"({stats['bytes']} bytes)")
+            archived += count
+    expired = store.expire_archives()
+    for user_id, count in sorted(expired.items()):
+        print(f"{user_id}: deleted {count} messages past their retention")
+    print(f"\nArchived {archived} messages, deleted {sum(expired.values())}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default=gc6.PRIVATE_CHATS_DIR, help="chat directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    inspect_parser = commands.add_parser("inspect", help="report how each chat is stored")
+    inspect_parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    inspect_parser.add_argument("users", nargs="*", help="users to inspect (default: all)")
+    inspect_parser.set_defaults(func=inspect)
+
+    migrate_parser = commands.add_parser("migrate", help="rewrite chats in the current log format")
+    migrate_parser.add_argument("--dry-run", action="store_true", help="only list the chats that would change")
+    migrate_parser.add_argument("users", nargs="*", help="users to migrate (default: all)")
+    migrate_parser.set_defaults(func=migrate)
+
+    archive_parser = commands.add_parser("archive", help="archive old messages and apply retention policies now")
+    archive_parser.add_argument("--archive-dir", default=gc6.CHAT_ARCHIVE_DIR, help="archive directory")
+    archive_parser.add_argument("users", nargs="*", help="users to archive (default: all)")
+    archive_parser.set_defaults(func=archive)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,47 @@
 import streamlit as st
 import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from uuid import uuid4
 import time
 import base64
-from PIL import Image
-import io
+import hashlib
+import secrets
+from PIL import Image, ImageOps, features
+import sqlite3
+import threading
+import queue
+import zlib
+import gzip
+import shutil
+import mimetypes
+import multiprocessing
+import warnings
+import bisect
+import sys
+import cProfile
+import pstats
+import urllib.parse
+import orjson
+from email.utils import formatdate
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; chats are then only locked within one process
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    # Optional; archived history is then compressed with gzip
+    zstandard = None
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 
 # Page configuration
 st.set_page_config(
@@ -16,26 +51,303 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+PRIVATE_CHATS_DIR = "database/private_chats"
+MEDIA_DIR = "database/media"
+THUMBNAIL_DIR = "database/thumbnails"
+
+# Images are processed in worker processes after they are sent: turned upright from their EXIF orientation,
+# stripped of metadata, thumbnailed in several widths and, when too large or carrying metadata, given a display copy
+THUMBNAIL_MAX_WIDTH = 400
+THUMBNAIL_WIDTHS = (200, 400, 800)
+THUMBNAIL_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+THUMBNAIL_QUALITY = 80
+MEDIA_DISPLAY_MAX_SIZE = 2048
+MEDIA_DISPLAY_QUALITY = 85
+MEDIA_MAX_PIXELS = 50_000_000
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", "2"))
+# An image whose processing keeps killing its worker is marked failed after this many attempts
+MEDIA_MAX_BROKEN_ATTEMPTS = 3
+
+# Rendered message HTML is reused across reruns and sessions until the message changes
+# Fragments with inlined thumbnails are tens of KB each, so the cache is bounded by size as well
+MESSAGE_HTML_CACHE_ENTRIES = 5000
+MESSAGE_HTML_CACHE_BYTES = 32 * 1024 * 1024
+
+# Media can be streamed to the browser by a small HTTP sidecar instead of being inlined into the page.
+# It has no authentication, so it only listens locally; set MEDIA_BASE_URL to the address the browser reaches it at
+# (e.g. a path on the reverse proxy in front of the app) to serve media by URL. Without it thumbnails are inlined
+# and videos are played through Streamlit's own media endpoint.
+MEDIA_SERVER_HOST = os.environ.get("MEDIA_SERVER_HOST", "127.0.0.1")
+MEDIA_SERVER_PORT = int(os.environ.get("MEDIA_SERVER_PORT", "8502"))
+MEDIA_BASE_URL = os.environ.get("MEDIA_BASE_URL", "").rstrip("/")
+# Only one process on a host can bind the port; the others retry so that one of them takes over when it exits
+MEDIA_SERVER_RETRY_INTERVAL = 5
+MEDIA_CACHE_MAX_AGE = 86400
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 86400
+MEDIA_CHUNK_SIZE = 256 * 1024
+
+# Timings and handled errors are served in the Prometheus text format at /metrics on the media server;
+# with several app processes, give each its own CHAT_METRICS_TEXTFILE for the node exporter to collect
+METRICS_ENABLED = os.environ.get("CHAT_METRICS", "1") != "0"
+METRICS_TEXTFILE = os.environ.get("CHAT_METRICS_TEXTFILE", "")
+METRICS_TEXTFILE_INTERVAL = 15
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_HELP = {
+    "chat_span_seconds": ("histogram", "Time spent in instrumented code paths"),
+    "chat_swallowed_errors_total": ("counter", "Errors handled without being shown, by where they were caught")
+}
+
+# Admins can profile their next few reruns; reports are kept here as pstats or collapsed stacks
+PROFILE_DIR = "database/profiles"
+PROFILE_MODES = ["cProfile", "Sampling"]
+PROFILE_MAX_RERUNS = 20
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TOP_FUNCTIONS = 15
+
+# Uploads are copied once, in chunks, into a staging file that is hashed and checked on the way,
+# then renamed into place when the message is sent
+UPLOAD_STAGING_DIR = f"{MEDIA_DIR}/.incoming"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_MB = 50
+UPLOAD_TYPES = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'mp4', 'avi', 'mov', 'wmv', 'flv', 'webm', 'mkv']
+
+# Media is stored once per distinct content as MEDIA_DIR/<first two hex digits>/<sha256>.<ext>;
+# messages reference it by hash and the index keeps a reference count per stored file
+MEDIA_HASH_CHARS = 64
+
+# Stored media no chat references any more is reclaimed in the background, one small batch per pass.
+# Files younger than the grace period are left alone so that an upload is never collected before it is sent.
+MEDIA_GC_INTERVAL = int(os.environ.get("MEDIA_GC_INTERVAL", "300"))
+MEDIA_GC_BATCH = 100
+MEDIA_GC_GRACE_SECONDS = 3600
+UPLOAD_STAGING_MAX_AGE = 86400
+MEDIA_USAGE_TOP_USERS = 5
+
+# Sessions rerun when a chat they watch changes; with no changes they refresh on an interval that backs off
+INBOX_CHANGE_KEY = "inbox"
+MEDIA_CHANGE_KEY = "media"
+CHANGE_WAIT_SLICE = 0.5
+IDLE_REFRESH_MAX_SECONDS = 120
+
+# Changes are also published to a feed table in the shared database, which every process polls, so that sessions
+# served by other processes and replicas refresh as well; a poll interval of 0 turns the feed off
+CHANGE_FEED_POLL_INTERVAL = float(os.environ.get("CHANGE_FEED_POLL_INTERVAL", "0.25"))
+CHANGE_FEED_RETENTION = 300
+CHANGE_FEED_PRUNE_INTERVAL = 60
+
+# With SESSION_URL_TOKENS=1, for replica deployments, a login is kept in the shared database behind a token in the
+# page URL, so a session that reconnects to another process or replica is still signed in. A token is exchanged for
+# a new one each time it signs a session in.
+SESSION_URL_TOKENS = os.environ.get("SESSION_URL_TOKENS", "0") != "0"
+SESSION_QUERY_PARAM = "session"
+SESSION_TTL_DAYS = 7
+
+# Background maintenance passes run in one process at a time, whichever holds the pass's lock file
+MAINTENANCE_LOCK_DIR = "database"
+
+# Store reads are shared by the sidebar, the inbox and all sessions until a change key they depend on moves;
+# the age limit bounds how stale a read can get from writes made by another process
+READ_CACHE_ENTRIES = 1000
+READ_CACHE_MAX_AGE = 5
+READ_CACHE_LOCK_STRIPES = 64
+
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("video/webm", ".webm")
+mimetypes.add_type("video/x-matroska", ".mkv")
+
+# Storage backend for private chats: "json" (one log file per user) or "sqlite"
+CHAT_STORE_BACKEND = os.environ.get("CHAT_STORE_BACKEND", "json")
+CHAT_DB_PATH = os.environ.get("CHAT_DB_PATH", "database/chats.db")
+SQLITE_SCHEMA_VERSION = 5
+
+# Derived indexes (such as the inbox summary) for the JSON backend live in their own database
+INDEX_DB_PATH = os.environ.get("CHAT_INDEX_DB_PATH", "database/index.db")
+INDEX_DB_VERSION = 5
+INBOX_PREVIEW_CHARS = 200
+
+# The admin inbox shows one page of conversations per rerun, filtered and sorted by the database
+INBOX_PAGE_SIZE = 25
+INBOX_SORT_ORDERS = {
+    "Most recent": "last_updated DESC",
+    "Most unread": "unread_count DESC, last_updated DESC",
+    "Most messages": "message_count DESC, last_updated DESC",
+    "Username": "user_id ASC"
+}
+INBOX_ACTIVE_SINCE = {
+    "Any time": None,
+    "Last hour": timedelta(hours=1),
+    "Last 24 hours": timedelta(days=1),
+    "Last 7 days": timedelta(days=7),
+    "Last 30 days": timedelta(days=30)
+}
+
+# Message text, captions and file names are searchable through an FTS5 index kept next to the inbox
+SEARCH_RESULTS_LIMIT = 20
+SEARCH_CONTEXT_MESSAGES = 5
+
+# Chats are stored as append-only JSON Lines logs: a header record followed by one record per message.
+# Version 2 replaced per-message read_by_admin flags with a read watermark (the last seq the admin has read).
+# Version 3 stores each message as a compact array (see Message) rather than an object.
+CHAT_LOG_VERSION = 3
+
+# Stored messages are arrays: the schema version, these fields in order, then an object with any other fields.
+# Trailing empty fields are left out. New fields go at the end; anything else needs a new schema version.
+MESSAGE_SCHEMA_VERSION = 1
+MESSAGE_FIELDS = {
+    "message_id": str,
+    "sender": str,
+    "timestamp": str,
+    "content": str,
+    "media_path": str,
+    "media_type": str,
+    "media_sha256": str,
+    "media_status": str,
+    "original_filename": str,
+    "media_width": int,
+    "media_height": int,
+    "thumbnails": dict,
+    "display_path": str
+}
+CHAT_PAGE_SIZE = 50
+CHAT_LOG_COMPACT_SLACK = 100
+
+# Chat files live in directories named by hex prefixes of a hash of the user id, so that user names never reach the
+# filesystem; the user id is kept in the log header. One level of 256 directories holds a few hundred chats each at
+# 100k users; a second level only adds directories to walk (see bench_chat.py --layout-users)
+CHAT_SHARD_DEPTH = 1
+
+# All but the newest messages of a chat are moved, a segment at a time, into immutable compressed files that are
+# only read when someone scrolls back that far. Retention applies to archived messages; 0 days keeps them forever.
+CHAT_ARCHIVE_DIR = os.environ.get("CHAT_ARCHIVE_DIR", "database/archive")
+CHAT_ARCHIVE_INTERVAL = int(os.environ.get("CHAT_ARCHIVE_INTERVAL", "600"))
+CHAT_ARCHIVE_BATCH = 20
+CHAT_ARCHIVE_SEGMENT_MESSAGES = 500
+CHAT_ARCHIVE_SUFFIX = ".jsonl.zst" if zstandard is not None else ".jsonl.gz"
+CHAT_HOT_MESSAGES = max(int(os.environ.get("CHAT_HOT_MESSAGES", "500")), CHAT_PAGE_SIZE)
+CHAT_RETENTION_DAYS = int(os.environ.get("CHAT_RETENTION_DAYS", "0"))
+CHAT_RETENTION_OPTIONS = {
+    "Forever": 0,
+    "5 years": 5 * 365,
+    "1 year": 365,
+    "90 days": 90,
+    "30 days": 30
+}
+
+# All chat writes go through one writer thread per process, which commits queued writes as a group
+GROUP_COMMIT_MAX_OPS = 256
+WRITE_ACK_TIMEOUT = 10
+CHAT_FSYNC = os.environ.get("CHAT_FSYNC", "1") != "0"
+CHAT_LOCK_STRIPES = 1024
+
 
 def format_message_time():
     return datetime.now().strftime("%H:%M:%S")
 
 
-def save_media_file(uploaded_file, message_id):
-    """Save uploaded media file and return the file path"""
+def _sniff_media_type(head):
+    """Tell from the leading bytes of a file whether it is an image or a video"""
+    if head.startswith((b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"BM")):
+        return "image"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image"
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+        return "video"
+    if head[4:8] in (b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip"):
+        return "video"
+    if head.startswith((b"\x1a\x45\xdf\xa3", b"FLV", b"\x30\x26\xb2\x75\x8e\x66\xcf\x11")):
+        return "video"
+    return None
+
+
+def ingest_upload(uploaded_file):
+    """Stream an uploaded file into the staging area, validating and hashing it chunk by chunk"""
+    upload = {
+        "file_id": getattr(uploaded_file, "file_id", None) or f"{uploaded_file.name}:{uploaded_file.size}",
+        "name": uploaded_file.name,
+        "size": uploaded_file.size,
+        "media_type": "image" if is_image_file(uploaded_file.name) else "video",
+        "sha256": None,
+        "path": None,
+        "error": None
+    }
+    max_bytes = MAX_UPLOAD_MB * 1024 * 1024
+    if upload["size"] > max_bytes:
+        upload["error"] = f"File too large! Please choose a file smaller than {MAX_UPLOAD_MB}MB."
+        return upload
+
+    os.makedirs(UPLOAD_STAGING_DIR, exist_ok=True)
+    staging_path = f"{UPLOAD_STAGING_DIR}/{uuid4()}.part"
+    digest = hashlib.sha256()
+    size = 0
     try:
-        if not os.path.exists("database/media"):
-            os.makedirs("database/media")
-
-        # Generate unique filename
-        file_extension = uploaded_file.name.split('.')[-1]
-        filename = f"{message_id}.{file_extension}"
-        file_path = f"database/media/{filename}"
-
-        # Save file
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-
+        uploaded_file.seek(0)
+        with open(staging_path, "wb") as f:
+            while chunk := uploaded_file.read(UPLOAD_CHUNK_SIZE):
+                if size == 0 and _sniff_media_type(chunk) != upload["media_type"]:
+                    raise ValueError(f"File contents do not look like a valid {upload['media_type']}.")
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"File too large! Please choose a file smaller than {MAX_UPLOAD_MB}MB.")
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise ValueError("File is empty.")
+        upload.update(size=size, sha256=digest.hexdigest(), path=staging_path)
+    except Exception as e:
+        upload["error"] = str(e) if isinstance(e, ValueError) else f"Error saving media file: {e}"
+        try:
+            os.remove(staging_path)
+        except OSError:
+            pass
+    finally:
+        uploaded_file.seek(0)
+    return upload
+
+
+def stage_upload(uploaded_file):
+    """Ingest the file in the uploader once and reuse the staged copy on later reruns"""
+    staged = st.session_state.staged_upload
+    file_id = getattr(uploaded_file, "file_id", None) or f"{uploaded_file.name}:{uploaded_file.size}"
+    if staged and staged["file_id"] == file_id:
+        return staged
+    discard_staged_upload()
+    staged = ingest_upload(uploaded_file)
+    st.session_state.staged_upload = staged
+    return staged
+
+
+def discard_staged_upload():
+    """Remove this session's staged upload, if any"""
+    staged = st.session_state.get("staged_upload")
+    st.session_state.staged_upload = None
+    if staged and staged["path"]:
+        try:
+            os.remove(staged["path"])
+        except OSError:
+            pass
+
+
+def _media_blob_path(sha256, file_extension):
+    return f"{MEDIA_DIR}/{sha256[:2]}/{sha256}.{file_extension.lower()}"
+
+
+def _is_media_blob(file_path):
+    """Check whether a path names a content-addressed media file, whose bytes never change"""
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    return (len(stem) == MEDIA_HASH_CHARS and os.path.basename(os.path.dirname(file_path)) == stem[:2]
+            and all(c in "0123456789abcdef" for c in stem))
+
+
+def commit_upload(upload):
+    """Move a staged upload into the content-addressed media store and return its path"""
+    try:
+        file_path = _media_blob_path(upload["sha256"], upload["name"].split('.')[-1])
+        if os.path.exists(file_path):
+            # The same content was uploaded before; the stored copy is shared
+            os.remove(upload["path"])
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(upload["path"], file_path)
         return file_path
     except Exception as e:
         st.error(f"Error saving media file: {e}")
@@ -63,116 +375,2708 @@ def is_video_file(filename):
     return any(filename.lower().endswith(ext) for ext in video_extensions)
 
 
-def save_private_chat_message(user_id, message):
-    """Save message to specific user's private chat with admin"""
+class LruCache:
+    """Bounded, thread-safe in-memory LRU shared between sessions
+
+    With max_bytes, values must support len() and the sum of their lengths is bounded too.
+    """
+
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _size(self, value):
+        return len(value) if self.max_bytes is not None else 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._size(self._entries.pop(key))
+            if self.max_bytes is not None and self._size(value) > self.max_bytes:
+                return
+            self._entries[key] = value
+            self.size += self._size(value)
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+                self.size -= self._size(self._entries.popitem(last=False)[1])
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._size(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+@st.cache_resource
+def get_message_html_cache():
+    """Return the LRU of rendered message fragments shared by all sessions"""
+    return LruCache(MESSAGE_HTML_CACHE_ENTRIES, MESSAGE_HTML_CACHE_BYTES)
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric_labels(labels):
+    """Format (name, value) pairs as a Prometheus label set"""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    """Thread-safe latency histograms and counters, rendered in the Prometheus text format"""
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, span, seconds):
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(span)
+            if histogram is None:
+                # Per-bucket counts, the last one for values above every bound, and the running sum
+                histogram = self._histograms[span] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            histograms = {span: (list(counts), total) for span, (counts, total) in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        for family, (kind, help_text) in METRICS_HELP.items():
+            lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"]
+            if kind == "histogram":
+                for span, (counts, total) in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip((*self.buckets, "+Inf"), counts):
+                        cumulative += count
+                        lines.append(f"{family}_bucket{_metric_labels((('span', span), ('le', bound)))} {cumulative}")
+                    lines.append(f"{family}_sum{_metric_labels((('span', span),))} {total}")
+                    lines.append(f"{family}_count{_metric_labels((('span', span),))} {cumulative}")
+            else:
+                for (name, labels), value in sorted(counters.items()):
+                    if name == family:
+                        lines.append(f"{family}{_metric_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+@st.cache_resource
+def get_metrics():
+    """Return the metrics shared by all sessions in this process"""
+    return Metrics()
+
+
+def observe_span(span, started):
+    """Record the time since a perf_counter reading under a span name"""
+    if METRICS_ENABLED:
+        get_metrics().observe(span, time.perf_counter() - started)
+
+
+@contextmanager
+def timed(span):
+    """Record how long a block takes under a span name"""
+    started = time.perf_counter()
     try:
-        if not os.path.exists("database/private_chats"):
-            os.makedirs("database/private_chats")
+        yield
+    finally:
+        observe_span(span, started)
+
+
+def count_error(where):
+    """Count an error that is handled without being shown"""
+    if METRICS_ENABLED:
+        get_metrics().count("chat_swallowed_errors_total", where=where)
+
+
+def write_metrics_textfile(metrics, path):
+    """Write the metrics atomically, for the node exporter's textfile collector"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(metrics.render())
+    os.replace(tmp_path, path)
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Background thread that samples one thread's call stack, counting each distinct stack root first"""
+
+    def __init__(self, thread_id, stacks, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.stacks = stacks
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
 
-        chat_file = f"database/private_chats/{user_id}.json"
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
 
-        if os.path.exists(chat_file):
-            with open(chat_file, "r") as f:
-                chat_data = json.load(f)
+
+@st.cache_resource
+def get_profiler_lock():
+    """Return the lock that lets one session at a time run cProfile, which newer Pythons allow once per process"""
+    return threading.Lock()
+
+
+@st.cache_resource
+def start_metrics_textfile():
+    """Start rewriting the metrics textfile periodically, once per process, or return None when it is disabled"""
+    if not (METRICS_ENABLED and METRICS_TEXTFILE):
+        return None
+    metrics = get_metrics()
+
+    def run():
+        while True:
+            time.sleep(METRICS_TEXTFILE_INTERVAL)
+            try:
+                write_metrics_textfile(metrics, METRICS_TEXTFILE)
+            except OSError:
+                count_error("metrics_textfile")
+
+    thread = threading.Thread(target=run, name="metrics-textfile", daemon=True)
+    thread.start()
+    return thread
+
+
+def _rendition_path(media_key, size):
+    """Return the path of a processed image; size is a thumbnail width or 'display'"""
+    return f"{THUMBNAIL_DIR}/{media_key}_{size}.{THUMBNAIL_FORMAT.lower()}"
+
+
+def _save_rendition(image, path, quality):
+    """Encode an image without its metadata and write it atomically"""
+    if THUMBNAIL_FORMAT == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    image.save(tmp_path, format=THUMBNAIL_FORMAT, quality=quality)
+    os.replace(tmp_path, path)
+
+
+def process_image(media_path, media_key, timings=None):
+    """Write the thumbnails and display copy of an image and return the fields to store on its message
+
+    Runs in a media worker process. Renditions already on disk for the same key are reused.
+    When a timings dict is given, the decode and encode times of the renditions written are stored in it.
+    """
+    started = time.perf_counter()
+    Image.MAX_IMAGE_PIXELS = MEDIA_MAX_PIXELS
+    with warnings.catch_warnings():
+        # Images over the pixel limit are rejected before anything is decoded
+        warnings.simplefilter("error", Image.DecompressionBombWarning)
+        with Image.open(media_path) as image:
+            exif = image.getexif()
+            width, height = image.size
+            if exif.get(0x0112, 1) in (5, 6, 7, 8):
+                width, height = height, width
+            needs_display_copy = (not getattr(image, "is_animated", False)
+                                  and (max(width, height) > MEDIA_DISPLAY_MAX_SIZE or len(exif) > 0))
+
+            fields = {"media_status": "ready", "media_width": width, "media_height": height,
+                      "thumbnails": {str(size): _rendition_path(media_key, size) for size in THUMBNAIL_WIDTHS}}
+            if needs_display_copy:
+                fields["display_path"] = _rendition_path(media_key, "display")
+            if all(os.path.exists(path) for path in [*fields["thumbnails"].values(), fields.get("display_path")]
+                   if path):
+                return fields
+
+            # Lets the JPEG decoder skip detail that no rendition keeps
+            image.draft("RGB", (MEDIA_DISPLAY_MAX_SIZE, MEDIA_DISPLAY_MAX_SIZE))
+            image = ImageOps.exif_transpose(image)
+
+    decoded = time.perf_counter()
+    if needs_display_copy:
+        image.thumbnail((MEDIA_DISPLAY_MAX_SIZE, MEDIA_DISPLAY_MAX_SIZE), Image.Resampling.LANCZOS)
+        _save_rendition(image, fields["display_path"], MEDIA_DISPLAY_QUALITY)
+    # Each thumbnail is shrunk from the next larger one
+    for size in sorted(THUMBNAIL_WIDTHS, reverse=True):
+        image.thumbnail((size, size * 4), Image.Resampling.LANCZOS)
+        _save_rendition(image, fields["thumbnails"][str(size)], THUMBNAIL_QUALITY)
+    if timings is not None:
+        # Encoding includes downscaling to each rendition's size
+        timings.update(image_decode=decoded - started, image_encode=time.perf_counter() - decoded)
+    return fields
+
+
+def _process_image_timed(media_path, media_key):
+    """Process an image in a media worker, returning its fields and timings for the parent process to record"""
+    timings = {}
+    return process_image(media_path, media_key, timings), timings
+
+
+def invalidate_thumbnail(media_key):
+    """Remove an image's processed renditions once its media is gone"""
+    legacy_thumbnail_path = f"{THUMBNAIL_DIR}/{media_key}.{THUMBNAIL_FORMAT.lower()}"
+    for path in [_rendition_path(media_key, size) for size in (*THUMBNAIL_WIDTHS, "display")] + [legacy_thumbnail_path]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    """Serve files from the media and thumbnail directories with caching and Range support"""
+
+    roots = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _resolve(self):
+        """Map the request path to a file inside one of the served directories"""
+        parts = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).strip("/").split("/")
+        if len(parts) < 2 or parts[0] not in self.roots or any(
+                part in ("", ".", "..") or "\\" in part for part in parts[1:]):
+            return None
+        file_path = os.path.join(self.roots[parts[0]], *parts[1:])
+        return file_path if os.path.isfile(file_path) else None
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve_metrics(self, send_body):
+        body = get_metrics().render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _serve(self, send_body):
+        if METRICS_ENABLED and urllib.parse.urlsplit(self.path).path == "/metrics":
+            self._serve_metrics(send_body)
+            return
+
+        file_path = self._resolve()
+        if file_path is None:
+            self.send_error(404)
+            return
+
+        stat = os.stat(file_path)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+        if self.headers.get("If-None-Match") == etag or (
+                "If-None-Match" not in self.headers and self.headers.get("If-Modified-Since") == last_modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        start, end = 0, stat.st_size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range", etag) in (etag, last_modified):
+            byte_range = _parse_byte_range(range_header, stat.st_size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.end_headers()
+                return
+            start, end = byte_range
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", mimetypes.guess_type(file_path)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if _is_media_blob(file_path):
+            # Content-addressed files never change under the same name
+            self.send_header("Cache-Control", f"public, max-age={MEDIA_IMMUTABLE_MAX_AGE}, immutable")
         else:
-            chat_data = {
-                "user_id": user_id,
-                "messages": [],
-                "created_at": datetime.now().isoformat(),
-                "last_updated": datetime.now().isoformat()
-            }
+            self.send_header("Cache-Control", f"public, max-age={MEDIA_CACHE_MAX_AGE}")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{stat.st_size}")
+        self.end_headers()
+
+        if send_body:
+            with open(file_path, "rb") as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(MEDIA_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+
+def _parse_byte_range(range_header, file_size):
+    """Parse a single "bytes=start-end" range, returning None when it cannot be satisfied"""
+    if not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    first, _, last = range_header[6:].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else file_size - 1
+        else:
+            # A suffix range asks for the last N bytes
+            start = max(file_size - int(last), 0)
+            end = file_size - 1
+    except ValueError:
+        return None
+    end = min(end, file_size - 1)
+    if start > end:
+        return None
+    return start, end
 
-        chat_data["messages"].append(message)
-        chat_data["last_updated"] = datetime.now().isoformat()
 
-        # Keep only last 500 messages per chat
-        if len(chat_data["messages"]) > 500:
-            chat_data["messages"] = chat_data["messages"][-500:]
+@st.cache_resource
+def start_media_server():
+    """Start the media sidecar once per process, or return None when it is disabled"""
+    if not MEDIA_SERVER_PORT:
+        return None
+
+    MediaRequestHandler.roots = {
+        "media": os.path.abspath(MEDIA_DIR),
+        "thumbnails": os.path.abspath(THUMBNAIL_DIR)
+    }
 
-        with open(chat_file, "w") as f:
-            json.dump(chat_data, f, indent=2)
+    def bind():
+        try:
+            server = ThreadingHTTPServer((MEDIA_SERVER_HOST, MEDIA_SERVER_PORT), MediaRequestHandler)
+        except OSError:
+            # Another process on this host is serving the same directories for now
+            return None
+        server.daemon_threads = True
+        return server
+
+    def run(server):
+        while server is None:
+            time.sleep(MEDIA_SERVER_RETRY_INTERVAL)
+            server = bind()
+        server.serve_forever()
+
+    # The first attempt is made here, so that a free port is serving before the first page renders
+    thread = threading.Thread(target=run, args=(bind(),), name="media-server", daemon=True)
+    thread.start()
+    return thread
+
+
+def media_url(kind, file_path):
+    """Return the browser URL for a file under the media or thumbnail directory, or None to inline it"""
+    if not MEDIA_SERVER_PORT or not MEDIA_BASE_URL:
+        return None
+    root = MEDIA_DIR if kind == "media" else THUMBNAIL_DIR
+    relative_path = os.path.relpath(file_path, root).replace(os.sep, "/")
+    return f"{MEDIA_BASE_URL}/{kind}/{urllib.parse.quote(relative_path)}"
+
+
+def json_dumps(value):
+    """Encode a value as compact JSON text"""
+    return orjson.dumps(value).decode()
+
+
+def json_loads(text):
+    """Decode JSON text or UTF-8 bytes"""
+    return orjson.loads(text)
+
+
+def _message_extra(message):
+    """Check a message dict against the schema, returning its fields outside the schema or None"""
+    extra = None
+    for name, value in message.items():
+        expected = MESSAGE_FIELDS.get(name)
+        if expected is None:
+            if extra is None:
+                extra = {}
+            extra[name] = value
+        elif value is not None and not isinstance(value, expected):
+            raise TypeError(f"Message field {name} must be {expected.__name__}, not {type(value).__name__}")
+    return extra
+
+
+def validate_message(message):
+    """Raise TypeError if a schema field of a message dict has the wrong type"""
+    _message_extra(message)
+
+
+def encode_message(message):
+    """Return the stored form of a message dict, rejecting schema fields of the wrong type"""
+    row = [MESSAGE_SCHEMA_VERSION, *map(message.get, MESSAGE_FIELDS), _message_extra(message)]
+    while row[-1] is None:
+        row.pop()
+    return row
+
+
+def decode_message(row):
+    """Return the message dict for a stored message"""
+    if isinstance(row, dict):
+        # Stored before messages were encoded as arrays
+        return dict(row)
+    if row[0] != MESSAGE_SCHEMA_VERSION:
+        raise ValueError(f"Unsupported message schema version {row[0]}")
+    message = dict(zip(MESSAGE_FIELDS, row[1:]))
+    if None in message.values():
+        message = {name: value for name, value in message.items() if value is not None}
+    if len(row) > len(MESSAGE_FIELDS) + 1:
+        message.update(row[-1])
+    return message
+
+
+def _parse_record(line):
+    """Parse one log line, returning None for blank or torn lines"""
+    if not line.strip():
+        return None
+    try:
+        return json_loads(line)
+    except ValueError:
+        # A torn trailing line from an interrupted append
+        return None
+
+
+def _trim_torn_tail(log_path, block_size=8192):
+    """Cut off a last line left unterminated by an interrupted append, so that the next append starts a new line"""
+    with open(log_path, "rb+") as f:
+        position = f.seek(0, os.SEEK_END)
+        if position == 0:
+            return
+        f.seek(position - 1)
+        if f.read(1) == b"\n":
+            return
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            newline = f.read(step).rfind(b"\n")
+            if newline != -1:
+                f.truncate(position + newline + 1)
+                return
+        f.truncate(0)
+
+
+def _iter_records_reversed(log_path, block_size=8192):
+    """Yield log records from newest to oldest without reading the whole file"""
+    # Parse time is summed and recorded once, when the caller stops reading
+    parse_seconds = 0.0
+    try:
+        with open(log_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b""
+
+            while position > 0:
+                step = min(block_size, position)
+                position -= step
+                f.seek(position)
+                lines = (f.read(step) + remainder).split(b"\n")
+                # The first line may continue in the previous block
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    started = time.perf_counter()
+                    record = _parse_record(line)
+                    parse_seconds += time.perf_counter() - started
+                    if record is not None:
+                        yield record
+
+            record = _parse_record(remainder)
+            if record is not None:
+                yield record
+    finally:
+        if METRICS_ENABLED:
+            get_metrics().observe("json_parse", parse_seconds)
+
+
+def _message_from_record(record):
+    """Return the message stored in a log record, tagged with its sequence number"""
+    message = decode_message(record["message"])
+    message["seq"] = record.get("seq", 0)
+    return message
+
+
+def _connect_sqlite(db_path):
+    """Open a SQLite connection in WAL mode with autocommit and row access by name"""
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+@contextmanager
+def _immediate_transaction(conn):
+    """Run a block inside a write transaction that is rolled back on error"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
     except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _read_watermark_from_flags(seq_messages):
+    """Return the read watermark implied by legacy read_by_admin flags, removing the flags
+
+    The watermark stops just before the first unread user message, given (seq, message) pairs in order.
+    """
+    read_seq = None
+    last_seq = 0
+    for seq, message in seq_messages:
+        if read_seq is None and message.get("sender") != "admin" and not message.get("read_by_admin", False):
+            read_seq = last_seq
+        message.pop("read_by_admin", None)
+        last_seq = seq
+    return last_seq if read_seq is None else read_seq
+
+
+def _message_preview(message):
+    """Return the subset of a message the inbox needs to show its preview"""
+    preview = {key: message[key] for key in ("message_id", "sender", "timestamp", "media_path", "media_type")
+               if key in message}
+    preview["content"] = message.get("content", "")[:INBOX_PREVIEW_CHARS]
+    return preview
+
+
+def _create_inbox_table(conn):
+    """Create the materialized inbox, one row per chat, kept sorted by last_updated"""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS inbox (
+            user_id TEXT PRIMARY KEY,
+            last_updated TEXT NOT NULL,
+            last_message TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            unread_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_inbox_last_updated ON inbox (last_updated);
+        CREATE INDEX IF NOT EXISTS idx_inbox_unread ON inbox (unread_count, last_updated);
+        CREATE INDEX IF NOT EXISTS idx_inbox_message_count ON inbox (message_count, last_updated);
+    """)
+
+
+def _inbox_record_message(conn, user_id, message, at):
+    """Update a chat's inbox row for one newly saved message"""
+    unread = 1 if message.get("sender") != "admin" else 0
+    conn.execute("""
+        INSERT INTO inbox (user_id, last_updated, last_message, message_count, unread_count)
+        VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            last_updated = excluded.last_updated,
+            last_message = excluded.last_message,
+            message_count = message_count + 1,
+            unread_count = unread_count + excluded.unread_count
+    """, (user_id, at, json.dumps(_message_preview(message)), unread))
+
+
+def _inbox_replace_chat(conn, user_id, last_updated, messages, read_seq):
+    """Recompute a chat's inbox row from its full message list and read watermark"""
+    unread_count = sum(1 for msg in messages if msg.get("sender") != "admin" and msg.get("seq", 0) > read_seq)
+    conn.execute(
+        "INSERT OR REPLACE INTO inbox (user_id, last_updated, last_message, message_count, unread_count) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (user_id, last_updated, json.dumps(_message_preview(messages[-1])) if messages else None,
+         len(messages), unread_count))
+
+
+def _create_media_tables(conn):
+    """Create the reference counts of stored media files and the media usage counters"""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS media_files (
+            media_path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL DEFAULT 0,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_media_files_refcount ON media_files (refcount, updated_at);
+
+        CREATE TABLE IF NOT EXISTS media_usage (
+            user_id TEXT PRIMARY KEY,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            files INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_media_usage_bytes ON media_usage (bytes);
+
+        -- Totals over media_files, kept current by triggers so that reading them costs one row
+        CREATE TABLE IF NOT EXISTS media_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            bytes INTEGER NOT NULL DEFAULT 0,
+            files INTEGER NOT NULL DEFAULT 0,
+            unreferenced_bytes INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO media_totals (id) VALUES (0);
+
+        CREATE TRIGGER IF NOT EXISTS media_files_insert AFTER INSERT ON media_files BEGIN
+            UPDATE media_totals SET bytes = bytes + NEW.size, files = files + 1,
+                unreferenced_bytes = unreferenced_bytes + (NEW.refcount = 0) * NEW.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS media_files_update AFTER UPDATE ON media_files BEGIN
+            UPDATE media_totals SET bytes = bytes + NEW.size - OLD.size,
+                unreferenced_bytes = unreferenced_bytes + (NEW.refcount = 0) * NEW.size - (OLD.refcount = 0) * OLD.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS media_files_delete AFTER DELETE ON media_files BEGIN
+            UPDATE media_totals SET bytes = bytes - OLD.size, files = files - 1,
+                unreferenced_bytes = unreferenced_bytes - (OLD.refcount = 0) * OLD.size;
+        END;
+    """)
+
+
+def _media_ref_add(conn, user_id, message, at, require_file=True):
+    """Count one more message referencing the message's media file and charge its size to the chat"""
+    media_path = message.get("media_path")
+    if not media_path:
+        return
+    try:
+        size = os.path.getsize(media_path)
+    except OSError:
+        # A file collected after the sender checked for it; the send fails and can be retried
+        if require_file:
+            raise
+        size = 0
+    conn.execute("""
+        INSERT INTO media_files (media_path, size, refcount, updated_at) VALUES (?, ?, 1, ?)
+        ON CONFLICT (media_path) DO UPDATE SET
+            size = excluded.size, refcount = refcount + 1, updated_at = excluded.updated_at
+    """, (media_path, size, at))
+    conn.execute("""
+        INSERT INTO media_usage (user_id, bytes, files) VALUES (?, ?, 1)
+        ON CONFLICT (user_id) DO UPDATE SET bytes = bytes + excluded.bytes, files = files + 1
+    """, (user_id, size))
+
+
+def _media_ref_release(conn, user_id, messages, at):
+    """Drop the references held by a cleared chat; unreferenced files are left for the collector"""
+    conn.executemany(
+        "UPDATE media_files SET refcount = MAX(refcount - 1, 0), updated_at = ? WHERE media_path = ?",
+        [(at, message["media_path"]) for message in messages if message.get("media_path")])
+    conn.execute("DELETE FROM media_usage WHERE user_id = ?", (user_id,))
+
+
+def _media_ref_expire(conn, user_id, messages, at):
+    """Drop the references held by messages removed from a chat that is kept, uncharging only their media"""
+    for message in messages:
+        if not message.get("media_path"):
+            continue
+        row = conn.execute("SELECT size FROM media_files WHERE media_path = ?", (message["media_path"],)).fetchone()
+        conn.execute("UPDATE media_usage SET bytes = MAX(bytes - ?, 0), files = MAX(files - 1, 0) WHERE user_id = ?",
+                     (row["size"] if row else 0, user_id))
+        conn.execute("UPDATE media_files SET refcount = MAX(refcount - 1, 0), updated_at = ? WHERE media_path = ?",
+                     (at, message["media_path"]))
+    conn.execute("DELETE FROM media_usage WHERE user_id = ? AND files = 0", (user_id,))
+
+
+def _clear_media_tables(conn):
+    conn.execute("DROP TABLE IF EXISTS media_refs")
+    conn.execute("DELETE FROM media_files")
+    conn.execute("DELETE FROM media_usage")
+
+
+def _remove_media_file(media_path):
+    """Delete a stored media file and the renditions made from it"""
+    try:
+        os.remove(media_path)
+    except FileNotFoundError:
         pass
+    # Renditions are keyed by the content hash, or by the message id for files saved before hashing
+    invalidate_thumbnail(os.path.splitext(os.path.basename(media_path))[0])
+
+
+def _collect_unreferenced_media(conn, limit, grace_seconds=MEDIA_GC_GRACE_SECONDS):
+    """Delete up to `limit` files whose reference count has been zero for the grace period"""
+    cutoff = (datetime.now() - timedelta(seconds=grace_seconds)).isoformat()
+    rows = conn.execute(
+        "SELECT media_path FROM media_files WHERE refcount = 0 AND updated_at < ? LIMIT ?",
+        (cutoff, limit)).fetchall()
+
+    removed_files = removed_bytes = 0
+    for row in rows:
+        # One short transaction per file: a message saved meanwhile either sees the file or fails to
+        with _immediate_transaction(conn):
+            current = conn.execute(
+                "SELECT size, refcount FROM media_files WHERE media_path = ?", (row["media_path"],)).fetchone()
+            if current is None or current["refcount"] > 0:
+                continue
+            conn.execute("DELETE FROM media_files WHERE media_path = ?", (row["media_path"],))
+            _remove_media_file(row["media_path"])
+        removed_files += 1
+        removed_bytes += current["size"]
+    return removed_files, removed_bytes
+
+
+def _sweep_untracked_media(conn, directory, grace_seconds=MEDIA_GC_GRACE_SECONDS):
+    """Delete files in one media directory that no message has ever referenced, such as abandoned uploads"""
+    cutoff = time.time() - grace_seconds
+    removed_files = removed_bytes = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0, 0
+
+    for entry in entries:
+        if not entry.is_file() or entry.stat().st_mtime >= cutoff:
+            continue
+        media_path = f"{directory}/{entry.name}"
+        with _immediate_transaction(conn):
+            if conn.execute("SELECT 1 FROM media_files WHERE media_path = ?", (media_path,)).fetchone():
+                continue
+            size = entry.stat().st_size
+            _remove_media_file(media_path)
+        removed_files += 1
+        removed_bytes += size
+    return removed_files, removed_bytes
+
+
+def _media_usage(conn, top_users=MEDIA_USAGE_TOP_USERS):
+    """Return stored media totals and the chats using the most media, from the maintained counters"""
+    totals = conn.execute("SELECT bytes, files, unreferenced_bytes FROM media_totals WHERE id = 0").fetchone()
+    users = conn.execute(
+        "SELECT user_id, bytes, files FROM media_usage ORDER BY bytes DESC LIMIT ?", (top_users,)).fetchall()
+    return {
+        "total_bytes": totals["bytes"],
+        "total_files": totals["files"],
+        "unreferenced_bytes": totals["unreferenced_bytes"],
+        "users": [{"user_id": row["user_id"], "bytes": row["bytes"], "files": row["files"]} for row in users]
+    }
+
+
+def _fts5_available():
+    try:
+        sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE probe USING fts5(text)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+# Without FTS5 in the SQLite build, search falls back to scanning the documents table
+SEARCH_FTS5 = _fts5_available()
+
+
+def _create_search_tables(conn):
+    """Create the searchable copy of every message and, when available, its FTS5 index"""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS search_docs (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            sender TEXT,
+            timestamp TEXT,
+            content TEXT,
+            original_filename TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_docs_chat ON search_docs (user_id, seq);
+    """)
+    if SEARCH_FTS5:
+        # An external-content index over search_docs, kept in step by triggers
+        conn.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+                content, original_filename, content = 'search_docs', content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 2'
+            );
+            CREATE TRIGGER IF NOT EXISTS search_docs_insert AFTER INSERT ON search_docs BEGIN
+                INSERT INTO message_search (rowid, content, original_filename)
+                VALUES (NEW.id, NEW.content, NEW.original_filename);
+            END;
+            CREATE TRIGGER IF NOT EXISTS search_docs_delete AFTER DELETE ON search_docs BEGIN
+                INSERT INTO message_search (message_search, rowid, content, original_filename)
+                VALUES ('delete', OLD.id, OLD.content, OLD.original_filename);
+            END;
+        """)
+
+
+def _search_add(conn, user_id, seq, message):
+    """Index one newly saved message"""
+    content = message.get("content", "")
+    original_filename = message.get("original_filename", "")
+    if not content and not original_filename:
+        return
+    conn.execute(
+        "INSERT INTO search_docs (user_id, seq, sender, timestamp, content, original_filename) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, seq, message.get("sender"), message.get("timestamp"), content, original_filename))
+
+
+def _search_remove(conn, user_id):
+    conn.execute("DELETE FROM search_docs WHERE user_id = ?", (user_id,))
+
+
+def _search_messages(conn, query, limit=SEARCH_RESULTS_LIMIT):
+    """Return the best matching messages across all chats, each with a highlighted snippet"""
+    terms = query.split()
+    if not terms:
+        return []
+
+    if SEARCH_FTS5:
+        # Every term must match, as a prefix, so that results appear while a word is still being typed
+        match = " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+        rows = conn.execute("""
+            SELECT d.user_id, d.seq, d.sender, d.timestamp, d.original_filename,
+                   snippet(message_search, -1, '**', '**', '…', 16) AS snippet
+            FROM message_search JOIN search_docs d ON d.id = message_search.rowid
+            WHERE message_search MATCH ?
+            ORDER BY bm25(message_search, 1.0, 0.5)
+            LIMIT ?
+        """, (match, limit)).fetchall()
+    else:
+        where = " AND ".join(["(content LIKE ? OR original_filename LIKE ?)"] * len(terms))
+        params = [value for term in terms for value in (f"%{term}%", f"%{term}%")]
+        rows = conn.execute(
+            f"SELECT user_id, seq, sender, timestamp, original_filename, content AS snippet FROM search_docs "
+            f"WHERE {where} ORDER BY id DESC LIMIT ?", (*params, limit)).fetchall()
+
+    return [{
+        "user_id": row["user_id"],
+        "seq": row["seq"],
+        "sender": row["sender"],
+        "timestamp": row["timestamp"],
+        "original_filename": row["original_filename"],
+        "snippet": row["snippet"]
+    } for row in rows]
+
+
+def _inbox_mark_read(conn, user_id):
+    conn.execute("UPDATE inbox SET unread_count = 0 WHERE user_id = ?", (user_id,))
+
+
+def _inbox_remove(conn, user_id):
+    conn.execute("DELETE FROM inbox WHERE user_id = ?", (user_id,))
+
+
+def _inbox_row(row):
+    return {
+        "user_id": row["user_id"],
+        "last_updated": row["last_updated"],
+        "message_count": row["message_count"],
+        "last_message": json.loads(row["last_message"]) if row["last_message"] else None,
+        "unread_count": row["unread_count"]
+    }
+
+
+def _inbox_list(conn):
+    """Return every inbox row, most recently updated first"""
+    rows = conn.execute(
+        "SELECT user_id, last_updated, last_message, message_count, unread_count "
+        "FROM inbox ORDER BY last_updated DESC").fetchall()
+    return [_inbox_row(row) for row in rows]
+
+
+def _inbox_page(conn, unread_only=False, active_since=None, sort="Most recent", limit=INBOX_PAGE_SIZE, offset=0):
+    """Return one page of inbox rows matching the filters, and how many rows match in total"""
+    conditions = []
+    params = []
+    if unread_only:
+        conditions.append("unread_count > 0")
+    if active_since:
+        conditions.append("last_updated >= ?")
+        params.append(active_since)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    total = conn.execute(f"SELECT COUNT(*) FROM inbox {where}", params).fetchone()[0]
+    rows = conn.execute(
+        f"SELECT user_id, last_updated, last_message, message_count, unread_count FROM inbox {where} "
+        f"ORDER BY {INBOX_SORT_ORDERS[sort]} LIMIT ? OFFSET ?", (*params, limit, offset)).fetchall()
+    return [_inbox_row(row) for row in rows], total
+
+
+def _inbox_stats(conn):
+    """Return the number of chats and of unread messages without loading any rows"""
+    row = conn.execute("SELECT COUNT(*), COALESCE(SUM(unread_count), 0) FROM inbox").fetchone()
+    return {"chat_count": row[0], "unread_count": row[1]}
+
+
+def _chat_shard(user_id, depth=CHAT_SHARD_DEPTH):
+    """Return the stable relative path, without extension, under which a user's chat files are stored"""
+    digest = hashlib.sha256(user_id.encode("utf-8")).hexdigest()
+    return "/".join([digest[2 * level:2 * level + 2] for level in range(depth)] + [digest])
+
+
+def _is_plain_filename(name):
+    """Return whether a user id can be used as a file name in the flat layout without escaping its directory"""
+    return bool(name) and name not in (".", "..") and os.path.basename(name) == name and "\\" not in name
+
+
+def _create_archive_tables(conn):
+    """Create the index of archived history segments and the per-chat retention policies"""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            user_id TEXT NOT NULL,
+            first_seq INTEGER NOT NULL,
+            last_seq INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            last_at TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            PRIMARY KEY (user_id, first_seq)
+        );
+        CREATE TABLE IF NOT EXISTS retention_policies (
+            user_id TEXT PRIMARY KEY,
+            hot_messages INTEGER,
+            retention_days INTEGER
+        );
+    """)
+
+
+def _create_shared_tables(conn):
+    """Create the tables processes sharing a store coordinate through: the change feed and resumable logins"""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS change_feed (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            change_key TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_change_feed_at ON change_feed (at);
+        CREATE TABLE IF NOT EXISTS sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            is_admin INTEGER NOT NULL,
+            expires_at TEXT NOT NULL
+        );
+    """)
+
+
+def _session_token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _write_segment(path, records):
+    """Atomically write message records, with their messages as dicts, to a compressed segment file"""
+    with timed("json_dump"):
+        data = "".join(json_dumps({**record, "message": encode_message(record["message"])}) + "\n"
+                       for record in records).encode("utf-8")
+    with timed("archive_compress"):
+        data = zstandard.ZstdCompressor().compress(data) if path.endswith(".zst") else gzip.compress(data)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        if CHAT_FSYNC:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def _read_segment(path):
+    """Return the message records of a segment file, with their messages decoded to dicts"""
+    with open(path, "rb") as f:
+        data = f.read()
+    with timed("archive_decompress"):
+        if path.endswith(".zst"):
+            if zstandard is None:
+                raise RuntimeError(f"zstandard is needed to read {path}")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            data = gzip.decompress(data)
+
+    with timed("json_parse"):
+        records = [json_loads(line) for line in data.splitlines() if line]
+    for record in records:
+        record["message"] = decode_message(record["message"])
+    return records
+
+
+def _index_segment(conn, user_id, records, size, file_name):
+    """Record a segment file's seq range in archive_segments, inside the caller's transaction"""
+    conn.execute(
+        "INSERT OR REPLACE INTO archive_segments "
+        "(user_id, first_seq, last_seq, message_count, bytes, last_at, file_name) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (user_id, records[0]["seq"], records[-1]["seq"], len(records), size, records[-1].get("at", ""), file_name))
+
+
+def _archivable_count(messages, hot_messages):
+    """Return how many of the oldest messages to archive: whole segments, leaving at least hot_messages"""
+    count = max(len(messages) - hot_messages, 0) // CHAT_ARCHIVE_SEGMENT_MESSAGES * CHAT_ARCHIVE_SEGMENT_MESSAGES
+    for position, message in enumerate(messages[:count]):
+        # Media still being processed will be updated when it finishes, so it stays hot with everything after it
+        if message.get("media_status") == "processing":
+            return position // CHAT_ARCHIVE_SEGMENT_MESSAGES * CHAT_ARCHIVE_SEGMENT_MESSAGES
+    return count
+
+
+class ChatLocks:
+    """Per-chat mutual exclusion across threads and processes, striped over one lock file"""
+
+    def __init__(self, lock_path, stripes=CHAT_LOCK_STRIPES):
+        self.lock_path = lock_path
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._fd = None
+
+    @contextmanager
+    def hold(self, key):
+        stripe = zlib.crc32(key.encode()) % len(self._locks)
+        with self._locks[stripe]:
+            if fcntl is None:
+                yield
+                return
+
+            if self._fd is None:
+                lock_dir = os.path.dirname(self.lock_path)
+                if lock_dir and not os.path.exists(lock_dir):
+                    os.makedirs(lock_dir)
+                self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT)
+            # Record locks on one byte per stripe; other threads of this process are held off above
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+
+
+class ChatStore:
+    """Interface implemented by the private chat storage backends
+
+    Mutations are ("append", user_id, message), ("update", user_id, fields), ("mark_read", user_id, None) and
+    ("clear", user_id, None) tuples; an update merges its fields into the message with the same message_id.
+    apply_batch applies a group of them, in order, and returns one exception or None per operation.
+    """
+
+    def apply_batch(self, ops):
+        raise NotImplementedError
+
+    def _load_hot_messages(self, user_id):
+        """Return the messages of a chat that have not been archived, oldest first"""
+        raise NotImplementedError
+
+    def _load_hot_page(self, user_id, before_seq, after_seq, limit):
+        """Return a page of the messages that have not been archived, as load_page does"""
+        raise NotImplementedError
+
+    def archive_chat(self, user_id):
+        """Move a chat's oldest messages into archive segments, returning how many were moved"""
+        raise NotImplementedError
+
+    def list_chats(self):
+        raise NotImplementedError
+
+    def load_messages(self, user_id):
+        """Return a chat's whole history, archived messages included, oldest first"""
+        messages = self._load_hot_messages(user_id)
+        first_seq = messages[0]["seq"] if messages else None
+        archived = []
+        for segment in reversed(self._archive_segments(user_id, before_seq=first_seq)):
+            archived.extend(message for message in self._read_archived_messages(user_id, segment["file_name"])
+                            if first_seq is None or message["seq"] < first_seq)
+        return archived + messages
+
+    def load_page(self, user_id, before_seq=None, after_seq=0, limit=CHAT_PAGE_SIZE):
+        """Return the newest `limit` messages with after_seq < seq < before_seq, oldest first, and a cursor
+
+        The cursor is the before_seq for the next older page, or None when no older messages exist.
+        A limit of None returns the whole window.
+        """
+        messages, older_cursor = self._load_hot_page(user_id, before_seq, after_seq, limit)
+        if older_cursor is not None:
+            return messages, older_cursor
+
+        # Anything older is archived; a segment is only decompressed once the page reaches back into it
+        before_seq = messages[0]["seq"] if messages else before_seq
+        for segment in self._archive_segments(user_id, before_seq, after_seq):
+            if limit is not None and len(messages) >= limit:
+                return messages, messages[0]["seq"]
+            archived = [message for message in self._read_archived_messages(user_id, segment["file_name"])
+                        if after_seq < message["seq"] and (before_seq is None or message["seq"] < before_seq)]
+            wanted = len(archived) if limit is None else limit - len(messages)
+            messages = archived[-wanted:] + messages
+            if wanted < len(archived):
+                return messages, messages[0]["seq"]
+        return messages, None
+
+    def _archive_segments(self, user_id, before_seq=None, after_seq=0):
+        """Return the index rows of a chat's archive segments holding seqs in the window, newest first"""
+        return self._index_db().execute(
+            "SELECT first_seq, last_seq, message_count, bytes, last_at, file_name FROM archive_segments "
+            "WHERE user_id = ? AND first_seq < ? AND last_seq > ? ORDER BY first_seq DESC",
+            (user_id, before_seq if before_seq is not None else 2 ** 63 - 1, after_seq)).fetchall()
+
+    def _read_archived_messages(self, user_id, file_name):
+        records = _read_segment(f"{self._archive_path(user_id)}/{file_name}")
+        return [_message_from_record(record) for record in records]
+
+    def _archive_path(self, user_id):
+        """Return the directory holding a chat's archive segments"""
+        archive_path = f"{self.archive_dir}/{_chat_shard(user_id)}"
+        flat_path = f"{self.archive_dir}/{user_id}"
+        if not os.path.exists(archive_path) and _is_plain_filename(user_id) and os.path.isdir(flat_path):
+            # Archived before chats were sharded
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            os.replace(flat_path, archive_path)
+        return archive_path
+
+    def _archive_records(self, conn, user_id, records):
+        """Write message records to new segment files and index them, inside the caller's transaction"""
+        for start in range(0, len(records), CHAT_ARCHIVE_SEGMENT_MESSAGES):
+            segment = records[start:start + CHAT_ARCHIVE_SEGMENT_MESSAGES]
+            first_seq, last_seq = segment[0]["seq"], segment[-1]["seq"]
+            # Named by seq range, so archiving again after a crash rewrites the same segment
+            file_name = f"{first_seq:010d}-{last_seq:010d}{CHAT_ARCHIVE_SUFFIX}"
+            size = _write_segment(f"{self._archive_path(user_id)}/{file_name}", segment)
+            _index_segment(conn, user_id, segment, size, file_name)
+
+    def _clear_archive(self, conn, user_id, at):
+        """Delete a chat's archive, releasing the media its messages referenced, inside the caller's transaction"""
+        for segment in self._archive_segments(user_id):
+            _media_ref_release(conn, user_id, self._read_archived_messages(user_id, segment["file_name"]), at)
+        conn.execute("DELETE FROM archive_segments WHERE user_id = ?", (user_id,))
+        shutil.rmtree(self._archive_path(user_id), ignore_errors=True)
+
+    def _rebuild_archive_index(self, conn, user_ids):
+        """Re-index the segment files of the given chats, returning their archived records by chat"""
+        conn.execute("DELETE FROM archive_segments")
+        archived = {}
+        for user_id in user_ids:
+            archive_path = self._archive_path(user_id)
+            if not os.path.isdir(archive_path):
+                continue
+            for file_name in sorted(os.listdir(archive_path)):
+                if not file_name.endswith((".jsonl.gz", ".jsonl.zst")):
+                    continue
+                records = _read_segment(f"{archive_path}/{file_name}")
+                if records:
+                    _index_segment(conn, user_id, records, os.path.getsize(f"{archive_path}/{file_name}"), file_name)
+                    archived.setdefault(user_id, []).extend(records)
+        return archived
+
+    def archive_candidates(self, limit=CHAT_ARCHIVE_BATCH):
+        """Return chats holding at least a whole segment more unarchived messages than their policy keeps"""
+        rows = self._index_db().execute("""
+            SELECT i.user_id FROM inbox i LEFT JOIN retention_policies p ON p.user_id = i.user_id
+            WHERE i.message_count - COALESCE(
+                    (SELECT SUM(s.message_count) FROM archive_segments s WHERE s.user_id = i.user_id), 0)
+                  >= COALESCE(p.hot_messages, ?) + ?
+            LIMIT ?
+        """, (CHAT_HOT_MESSAGES, CHAT_ARCHIVE_SEGMENT_MESSAGES, limit)).fetchall()
+        return [row["user_id"] for row in rows]
+
+    def expire_archives(self):
+        """Delete archive segments older than their chat's retention period, returning messages removed per chat"""
+        conn = self._index_db()
+        rows = conn.execute("""
+            SELECT s.user_id, s.first_seq, s.last_at, COALESCE(p.retention_days, ?) AS retention_days
+            FROM archive_segments s LEFT JOIN retention_policies p ON p.user_id = s.user_id
+            WHERE COALESCE(p.retention_days, ?) > 0
+        """, (CHAT_RETENTION_DAYS, CHAT_RETENTION_DAYS)).fetchall()
+
+        now = datetime.now()
+        removed = {}
+        for row in rows:
+            if row["last_at"] >= (now - timedelta(days=row["retention_days"])).isoformat():
+                continue
+            try:
+                segment = self._expire_segment(conn, row["user_id"], row["first_seq"], now)
+            except Exception:
+                # A corrupt segment is kept, and retried on the next pass, without holding up the other chats
+                count_error("expire_archives")
+                continue
+            if segment is None:
+                continue
+            try:
+                os.remove(f"{self._archive_path(row['user_id'])}/{segment['file_name']}")
+            except FileNotFoundError:
+                pass
+            removed[row["user_id"]] = removed.get(row["user_id"], 0) + segment["message_count"]
+        return removed
+
+    def _expire_segment(self, conn, user_id, first_seq, now):
+        """Drop one archive segment from the indexes, returning its index row, or None if it is already gone"""
+        with _immediate_transaction(conn):
+            # Re-read inside the transaction, in case the chat was cleared meanwhile
+            segment = conn.execute(
+                "SELECT last_seq, message_count, file_name FROM archive_segments WHERE user_id = ? AND first_seq = ?",
+                (user_id, first_seq)).fetchone()
+            if segment is None:
+                return None
+            try:
+                messages = self._read_archived_messages(user_id, segment["file_name"])
+            except FileNotFoundError:
+                # The messages are gone already; the media they referenced is re-counted when the index is rebuilt
+                count_error("expire_archives")
+                messages = []
+            _media_ref_expire(conn, user_id, messages, now.isoformat())
+            conn.execute("DELETE FROM search_docs WHERE user_id = ? AND seq BETWEEN ? AND ?",
+                         (user_id, first_seq, segment["last_seq"]))
+            conn.execute("UPDATE inbox SET message_count = MAX(message_count - ?, 0) WHERE user_id = ?",
+                         (segment["message_count"], user_id))
+            conn.execute("DELETE FROM archive_segments WHERE user_id = ? AND first_seq = ?", (user_id, first_seq))
+        return segment
+
+    def retention_policy(self, user_id):
+        """Return how many messages a chat keeps unarchived and for how many days archived ones are kept"""
+        row = self._index_db().execute(
+            "SELECT hot_messages, retention_days FROM retention_policies WHERE user_id = ?", (user_id,)).fetchone()
+        return {
+            "hot_messages": row["hot_messages"] if row and row["hot_messages"] is not None else CHAT_HOT_MESSAGES,
+            "retention_days": row["retention_days"] if row and row["retention_days"] is not None
+            else CHAT_RETENTION_DAYS
+        }
+
+    def set_retention_policy(self, user_id, hot_messages=None, retention_days=None):
+        """Set a chat's retention policy; None restores the default for that setting"""
+        if hot_messages is not None:
+            # The first page is always served without reading the archive
+            hot_messages = max(hot_messages, CHAT_PAGE_SIZE)
+        self._index_db().execute(
+            "INSERT OR REPLACE INTO retention_policies (user_id, hot_messages, retention_days) VALUES (?, ?, ?)",
+            (user_id, hot_messages, retention_days))
+
+    def publish_changes(self, keys, origin):
+        """Add change keys to the feed read by every process sharing this store"""
+        now = time.time()
+        self._index_db().executemany("INSERT INTO change_feed (change_key, origin, at) VALUES (?, ?, ?)",
+                                     [(key, origin, now) for key in keys])
+
+    def read_changes(self, after_id):
+        """Return the feed entries added after an id, oldest first"""
+        return self._index_db().execute(
+            "SELECT id, change_key, origin FROM change_feed WHERE id > ? ORDER BY id", (after_id,)).fetchall()
+
+    def last_change_id(self):
+        return self._index_db().execute("SELECT COALESCE(MAX(id), 0) FROM change_feed").fetchone()[0]
+
+    def prune_changes(self, max_age=CHANGE_FEED_RETENTION):
+        self._index_db().execute("DELETE FROM change_feed WHERE at < ?", (time.time() - max_age,))
+
+    def create_session(self, user_id, is_admin, ttl_days=SESSION_TTL_DAYS):
+        """Record a login and return the token that resumes it; only a hash of the token is stored"""
+        token = secrets.token_urlsafe(32)
+        conn = self._index_db()
+        conn.execute("DELETE FROM sessions WHERE expires_at < ?", (datetime.now().isoformat(),))
+        conn.execute("INSERT INTO sessions (token_hash, user_id, is_admin, expires_at) VALUES (?, ?, ?, ?)",
+                     (_session_token_hash(token), user_id, int(is_admin),
+                      (datetime.now() + timedelta(days=ttl_days)).isoformat()))
+        return token
+
+    def resume_session(self, token):
+        """Return the (user_id, is_admin) a login token was issued for, or None when it is unknown or expired"""
+        row = self._index_db().execute(
+            "SELECT user_id, is_admin FROM sessions WHERE token_hash = ? AND expires_at >= ?",
+            (_session_token_hash(token), datetime.now().isoformat())).fetchone()
+        return (row["user_id"], bool(row["is_admin"])) if row else None
+
+    def end_session(self, token):
+        self._index_db().execute("DELETE FROM sessions WHERE token_hash = ?", (_session_token_hash(token),))
+
+    def rotate_session(self, token, ttl_days=SESSION_TTL_DAYS):
+        """Replace a login token with a new one, returning (new_token, user_id, is_admin) or None when it is not valid"""
+        conn = self._index_db()
+        with _immediate_transaction(conn):
+            login = self.resume_session(token)
+            if login is None:
+                return None
+            self.end_session(token)
+            return self.create_session(*login, ttl_days=ttl_days), *login
+
+    def archive_stats(self, user_id):
+        """Return the number of segments, messages and compressed bytes in a chat's archive"""
+        row = self._index_db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(message_count), 0), COALESCE(SUM(bytes), 0) FROM archive_segments "
+            "WHERE user_id = ?", (user_id,)).fetchone()
+        return {"segments": row[0], "messages": row[1], "bytes": row[2]}
+
+    def _index_db(self):
+        """Return the connection holding the derived tables: inbox, media counters and search index"""
+        raise NotImplementedError
+
+    def collect_media(self, limit=MEDIA_GC_BATCH):
+        """Reclaim a batch of unreferenced media files, returning how many files and bytes were freed"""
+        return _collect_unreferenced_media(self._index_db(), limit)
+
+    def sweep_media_directory(self, directory):
+        """Reclaim files in one media directory that were never referenced by a message"""
+        return _sweep_untracked_media(self._index_db(), directory)
+
+    def media_usage(self):
+        return _media_usage(self._index_db())
+
+    def list_chats_page(self, unread_only=False, active_since=None, sort="Most recent", limit=INBOX_PAGE_SIZE,
+                        offset=0):
+        """Return one filtered, sorted page of the inbox and the number of chats matching the filters"""
+        return _inbox_page(self._index_db(), unread_only, active_since, sort, limit, offset)
+
+    def inbox_stats(self):
+        return _inbox_stats(self._index_db())
+
+    def search_messages(self, query, limit=SEARCH_RESULTS_LIMIT):
+        """Return ranked matches for a search across every chat"""
+        return _search_messages(self._index_db(), query, limit)
+
+    def _apply_one(self, op):
+        error = self.apply_batch([op])[0]
+        if error is not None:
+            raise error
+
+    def append_message(self, user_id, message):
+        self._apply_one(("append", user_id, message))
+
+    def update_message(self, user_id, message_id, fields):
+        self._apply_one(("update", user_id, {**fields, "message_id": message_id}))
+
+    def mark_read(self, user_id):
+        self._apply_one(("mark_read", user_id, None))
+
+    def clear_chat(self, user_id):
+        self._apply_one(("clear", user_id, None))
+
+
+class JsonChatStore(ChatStore):
+    """Chats stored as append-only JSON Lines logs, one file per user"""
+
+    def __init__(self, root=PRIVATE_CHATS_DIR, index_db_path=INDEX_DB_PATH, archive_dir=CHAT_ARCHIVE_DIR):
+        self.root = root
+        self.index_db_path = index_db_path
+        self.archive_dir = archive_dir
+        self.locks = ChatLocks(f"{root}/.chats.lock")
+        self._local = threading.local()
+
+    def _index(self):
+        """Return this thread's connection to the inbox index, building it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _connect_sqlite(self.index_db_path)
+            _create_inbox_table(conn)
+            _create_media_tables(conn)
+            _create_search_tables(conn)
+            _create_archive_tables(conn)
+            _create_shared_tables(conn)
+            self._local.conn = conn
+            if conn.execute("PRAGMA user_version").fetchone()[0] < INDEX_DB_VERSION:
+                self.rebuild_inbox_index()
+        return conn
+
+    def rebuild_inbox_index(self):
+        """Rebuild the inbox, media reference, search and archive indexes by reading every chat log and segment once"""
+        conn = self._index()
+        self.migrate_legacy_chats()
+        chat_files = dict(self.chat_files())
+
+        with _immediate_transaction(conn):
+            conn.execute("DELETE FROM inbox")
+            conn.execute("DELETE FROM search_docs")
+            _clear_media_tables(conn)
+            archived = self._rebuild_archive_index(conn, chat_files)
+            for user_id, log_path in chat_files.items():
+                header, records = self._read_log(log_path)
+                first_seq = records[0].get("seq", 0) if records else None
+                records = [record for record in archived.get(user_id, [])
+                           if first_seq is None or record["seq"] < first_seq] + records
+                messages = [_message_from_record(record) for record in records]
+                _inbox_replace_chat(conn, user_id, header["last_updated"], messages, header["read_seq"])
+                for record in records:
+                    _media_ref_add(conn, user_id, record["message"], record.get("at", header["last_updated"]),
+                                   require_file=False)
+                    _search_add(conn, user_id, record.get("seq", 0), record["message"])
+            conn.execute(f"PRAGMA user_version = {INDEX_DB_VERSION}")
+
+    def chat_path(self, user_id):
+        """Return where a user's chat log is stored, whether or not it exists"""
+        return f"{self.root}/{_chat_shard(user_id)}.jsonl"
+
+    def chat_files(self):
+        """Yield (user_id, log path) for every chat log, reading the user id from each log's header"""
+        for directory, _, filenames in os.walk(self.root):
+            if directory == self.root:
+                # Only logs in the flat layout, which are migrated on first use, live at the top
+                continue
+            for filename in filenames:
+                if not filename.endswith(".jsonl"):
+                    continue
+                with open(f"{directory}/{filename}", "rb") as f:
+                    header = _parse_record(f.readline())
+                if header is None or header.get("op") != "header" or not header.get("user_id"):
+                    count_error("chat_files")
+                    continue
+                yield header["user_id"], f"{directory}/{filename}"
+
+    def _log_path(self, user_id):
+        """Return the log path for a user's chat, first moving it out of the flat layout or a legacy file"""
+        log_path = self.chat_path(user_id)
+        if not os.path.exists(log_path) and _is_plain_filename(user_id):
+            self.migrate_flat_chat(user_id)
+        return log_path
+
+    def migrate_flat_chat(self, user_id):
+        """Move a chat stored as {user_id}.jsonl or {user_id}.json directly under the root into its shard"""
+        flat_path = f"{self.root}/{user_id}.jsonl"
+        with self.locks.hold(user_id):
+            if os.path.exists(flat_path) and not os.path.exists(self.chat_path(user_id)):
+                os.makedirs(os.path.dirname(self.chat_path(user_id)), exist_ok=True)
+                os.replace(flat_path, self.chat_path(user_id))
+        if os.path.exists(f"{self.root}/{user_id}.json"):
+            self.migrate_legacy_chat(user_id)
+
+    def _read_log(self, log_path):
+        """Read a chat log and return its header and message records, with their messages decoded to dicts"""
+        header = {}
+        records = []
+        records_by_seq = {}
+        read_seq = 0
+        folded_records = 0
+        parse_seconds = 0.0
+
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                started = time.perf_counter()
+                record = _parse_record(line)
+                parse_seconds += time.perf_counter() - started
+                if record is None:
+                    continue
+                if record.get("op") == "header":
+                    header = record
+                    read_seq = max(read_seq, record.get("read_seq", 0))
+                elif record.get("op") == "message":
+                    record["message"] = decode_message(record["message"])
+                    records.append(record)
+                    records_by_seq[record.get("seq", 0)] = record
+                elif record.get("op") == "update":
+                    if record.get("seq") in records_by_seq:
+                        records_by_seq[record["seq"]]["message"].update(record.get("fields", {}))
+                    folded_records += 1
+                elif record.get("op") == "read":
+                    read_seq = max(read_seq, record.get("seq", 0))
+                    folded_records += 1
+
+        if METRICS_ENABLED:
+            get_metrics().observe("json_parse", parse_seconds)
+
+        if header.get("version", 1) < 2:
+            read_seq = _read_watermark_from_flags((record.get("seq", 0), record["message"]) for record in records)
+
+        header["read_seq"] = read_seq
+        header["folded_records"] = folded_records
+        header["last_updated"] = records[-1].get("at", "") if records else header.get("created_at", "")
+        return header, records
+
+    def _read_tail(self, log_path):
+        """Return the last message seq and whether it is covered by a read record, reading only the tail"""
+        read_seq = 0
+        for record in _iter_records_reversed(log_path):
+            if record.get("op") == "read":
+                read_seq = max(read_seq, record.get("seq", 0))
+            elif record.get("op") == "message":
+                return record.get("seq", 0), read_seq
+            elif record.get("op") == "header":
+                return 0, max(read_seq, record.get("read_seq", 0))
+        return 0, read_seq
+
+    def _find_seq(self, log_path, message_id):
+        """Return the seq of a message by id, searching from the end of the log"""
+        for record in _iter_records_reversed(log_path):
+            if record.get("op") == "header":
+                break
+            if record.get("op") == "message" and decode_message(record["message"]).get("message_id") == message_id:
+                return record.get("seq")
+        return None
+
+    def _write_log(self, log_path, header, records):
+        """Atomically rewrite a chat log with the given header and message records"""
+        tmp_path = f"{log_path}.tmp"
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+
+        with timed("json_dump"):
+            lines = [json_dumps({
+                "op": "header",
+                "user_id": header.get("user_id"),
+                "created_at": header.get("created_at", datetime.now().isoformat()),
+                "read_seq": header.get("read_seq", 0),
+                "version": CHAT_LOG_VERSION
+            })] + [json_dumps({**record, "message": encode_message(record["message"])}) for record in records]
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+        os.replace(tmp_path, log_path)
+
+    def compact_log(self, user_id):
+        """Rewrite a chat log folding read records into the header and updates into their messages"""
+        log_path = self._log_path(user_id)
+        with self.locks.hold(user_id):
+            # Re-read under the lock so that appends made since the caller's read are kept
+            if os.path.exists(log_path):
+                header, records = self._read_log(log_path)
+                self._write_log(log_path, header, records)
+
+    def archive_chat(self, user_id):
+        log_path = self._log_path(user_id)
+        hot_messages = self.retention_policy(user_id)["hot_messages"]
+        index = self._index()
+        with self.locks.hold(user_id):
+            if not os.path.exists(log_path):
+                return 0
+            header, records = self._read_log(log_path)
+            count = _archivable_count([record["message"] for record in records], hot_messages)
+            if not count:
+                return 0
+            with _immediate_transaction(index):
+                self._archive_records(index, user_id, records[:count])
+            # The archived messages stay in the log until this rewrite; readers skip archived seqs they also find there
+            self._write_log(log_path, header, records[count:])
+        return count
+
+    def migrate_legacy_chat(self, user_id):
+        """Convert a legacy {user_id}.json chat file into the append-only log format"""
+        legacy_path = f"{self.root}/{user_id}.json"
+        try:
+            with self.locks.hold(user_id):
+                if not os.path.exists(legacy_path) or os.path.exists(self.chat_path(user_id)):
+                    return
+                with open(legacy_path, "r") as f:
+                    chat_data = json.load(f)
+
+                at = chat_data.get("last_updated", datetime.now().isoformat())
+                records = [
+                    {"op": "message", "seq": seq, "at": at, "message": message}
+                    for seq, message in enumerate(chat_data.get("messages", []), start=1)
+                ]
+                header = {
+                    "user_id": user_id,
+                    "created_at": chat_data.get("created_at", at),
+                    "read_seq": _read_watermark_from_flags((record["seq"], record["message"]) for record in records)
+                }
+                self._write_log(self.chat_path(user_id), header, records)
+                os.remove(legacy_path)
+        except Exception:
+            count_error("migrate_legacy_chat")
+
+    def migrate_legacy_chats(self):
+        """Move every chat in the flat layout into its shard, converting legacy chat files on the way"""
+        if not os.path.exists(self.root):
+            return
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.endswith((".json", ".jsonl")):
+                self.migrate_flat_chat(os.path.splitext(entry.name)[0])
+
+    def apply_batch(self, ops):
+        index = self._index()
+        results = [None] * len(ops)
+
+        # Group operations by chat, keeping their order; each chat's group is one append and one fsync
+        chat_ops = {}
+        for position, op in enumerate(ops):
+            chat_ops.setdefault(op[1], []).append((position, op))
+
+        for user_id, entries in chat_ops.items():
+            try:
+                self._apply_chat_group(index, user_id, [op for _, op in entries])
+            except Exception as e:
+                if len(entries) == 1:
+                    results[entries[0][0]] = e
+                    continue
+                # Retry one by one so that a single bad operation does not fail the others
+                for position, op in entries:
+                    try:
+                        self._apply_chat_group(index, user_id, [op])
+                    except Exception as error:
+                        results[position] = error
+        return results
+
+    def _apply_chat_group(self, index, user_id, ops):
+        log_path = self._log_path(user_id)
+        with self.locks.hold(user_id), _immediate_transaction(index):
+            self._apply_chat_ops(index, log_path, user_id, ops)
+
+    def _apply_chat_ops(self, index, log_path, user_id, ops):
+        """Apply one chat's operations, writing all new records with a single append"""
+        now = datetime.now().isoformat()
+        exists = os.path.exists(log_path)
+        if exists:
+            # A record torn by an interrupted write was never acknowledged; appending after it would corrupt the next
+            _trim_torn_tail(log_path)
+            exists = os.path.getsize(log_path) > 0
+        # Only the tail of the log is read to find the next sequence number and the read watermark
+        last_seq, read_seq = self._read_tail(log_path) if exists else (0, 0)
+        new_records = []
+        appended = []
+        appended_seqs = {}
+
+        for kind, _, message in ops:
+            if kind == "append":
+                if not exists and not new_records:
+                    new_records.append({
+                        "op": "header",
+                        "user_id": user_id,
+                        "created_at": now,
+                        "version": CHAT_LOG_VERSION
+                    })
+                last_seq += 1
+                new_records.append({"op": "message", "seq": last_seq, "at": now, "message": encode_message(message)})
+                appended.append(message)
+                appended_seqs[message.get("message_id")] = last_seq
+                _inbox_record_message(index, user_id, message, now)
+                _media_ref_add(index, user_id, message, now)
+                _search_add(index, user_id, last_seq, message)
+            elif kind == "update":
+                seq = appended_seqs.get(message["message_id"]) or (
+                    self._find_seq(log_path, message["message_id"]) if exists else None)
+                if seq is not None:
+                    fields = {key: value for key, value in message.items() if key != "message_id"}
+                    new_records.append({"op": "update", "seq": seq, "at": now, "fields": fields})
+            elif kind == "mark_read":
+                # Moving the watermark to the last message is one record, whatever the history length
+                if last_seq > read_seq:
+                    new_records.append({"op": "read", "seq": last_seq, "at": now})
+                    read_seq = last_seq
+                _inbox_mark_read(index, user_id)
+            elif kind == "clear":
+                if exists:
+                    appended = [record["message"] for record in self._read_log(log_path)[1]] + appended
+                _media_ref_release(index, user_id, appended, now)
+                self._clear_archive(index, user_id, now)
+                _search_remove(index, user_id)
+                new_records = []
+                appended = []
+                appended_seqs = {}
+                if os.path.exists(log_path):
+                    os.remove(log_path)
+                exists = False
+                last_seq = read_seq = 0
+                _inbox_remove(index, user_id)
+
+        if new_records:
+            with timed("json_dump"):
+                data = "\n".join(json_dumps(record) for record in new_records) + "\n"
+            if not exists:
+                os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            # Only the new records are written; the log is trimmed when it is next compacted
+            with open(log_path, "a", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                if CHAT_FSYNC:
+                    os.fsync(f.fileno())
+
+    def _load_hot_messages(self, user_id):
+        log_path = self._log_path(user_id)
+        if not os.path.exists(log_path):
+            return []
+
+        header, records = self._read_log(log_path)
+        if header["folded_records"] > CHAT_LOG_COMPACT_SLACK or header.get("version", 1) < CHAT_LOG_VERSION:
+            self.compact_log(user_id)
+        return [_message_from_record(record) for record in records]
+
+    def _load_hot_page(self, user_id, before_seq, after_seq, limit):
+        log_path = self._log_path(user_id)
+        if not os.path.exists(log_path):
+            return [], None
+
+        # Walk back from the end of the log, so only the requested window and what follows it are read
+        messages = []
+        updates = {}
+        has_older = False
+        for record in _iter_records_reversed(log_path):
+            if record.get("op") == "header":
+                break
+            if record.get("op") == "update":
+                # Seen before the message they apply to; older updates must not override newer ones
+                updates[record.get("seq")] = {**record.get("fields", {}), **updates.get(record.get("seq"), {})}
+                continue
+            if record.get("op") != "message" or (before_seq is not None and record.get("seq", 0) >= before_seq):
+                continue
+            if record.get("seq", 0) <= after_seq or (limit is not None and len(messages) >= limit):
+                has_older = True
+                break
+            message = _message_from_record(record)
+            message.update(updates.pop(record.get("seq"), {}))
+            messages.append(message)
+
+        messages.reverse()
+        return messages, (messages[0]["seq"] if messages and has_older else None)
+
+    def list_chats(self):
+        return _inbox_list(self._index())
+
+    def _index_db(self):
+        return self._index()
+
+
+class SqliteChatStore(ChatStore):
+    """Chats stored in a single SQLite database in WAL mode"""
+
+    def __init__(self, db_path=CHAT_DB_PATH, archive_dir=CHAT_ARCHIVE_DIR):
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        self._local = threading.local()
+
+    def _connect(self):
+        """Return this thread's connection, creating the schema on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _connect_sqlite(self.db_path)
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    user_id TEXT PRIMARY KEY,
+                    created_at TEXT NOT NULL,
+                    last_updated TEXT NOT NULL,
+                    read_seq INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    user_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    message_id TEXT,
+                    sender TEXT,
+                    created_at TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    PRIMARY KEY (user_id, seq)
+                );
+                CREATE INDEX IF NOT EXISTS idx_chats_last_updated ON chats (last_updated);
+                CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (user_id, sender);
+                CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (user_id, message_id);
+            """)
+            _create_inbox_table(conn)
+            _create_media_tables(conn)
+            _create_search_tables(conn)
+            _create_archive_tables(conn)
+            _create_shared_tables(conn)
+            self._local.conn = conn
+            if conn.execute("PRAGMA user_version").fetchone()[0] < SQLITE_SCHEMA_VERSION:
+                self._migrate_schema(conn)
+        return conn
+
+    def _migrate_schema(self, conn):
+        """Bring an older database up to the current schema and rebuild the derived tables"""
+        with _immediate_transaction(conn):
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 2:
+                self._migrate_read_watermark(conn)
+            if version < SQLITE_SCHEMA_VERSION:
+                self._rebuild_inbox(conn)
+                self._rebuild_media_refs(conn)
+                self._rebuild_search(conn)
+                conn.execute(f"PRAGMA user_version = {SQLITE_SCHEMA_VERSION}")
+
+    def _migrate_read_watermark(self, conn):
+        """Replace per-message read_by_admin flags with a per-chat read watermark"""
+        chat_columns = [row["name"] for row in conn.execute("PRAGMA table_info(chats)")]
+        if "read_seq" not in chat_columns:
+            conn.execute("ALTER TABLE chats ADD COLUMN read_seq INTEGER NOT NULL DEFAULT 0")
+
+        message_columns = [row["name"] for row in conn.execute("PRAGMA table_info(messages)")]
+        if "read_by_admin" in message_columns:
+            # The watermark stops just before the first unread user message
+            conn.execute("""
+                UPDATE chats SET read_seq = COALESCE(
+                    (SELECT MIN(seq) - 1 FROM messages m
+                      WHERE m.user_id = chats.user_id AND m.sender != 'admin' AND m.read_by_admin = 0),
+                    (SELECT MAX(seq) FROM messages m WHERE m.user_id = chats.user_id),
+                    0)
+            """)
+            conn.execute("DROP INDEX IF EXISTS idx_messages_unread")
+            try:
+                conn.execute("ALTER TABLE messages DROP COLUMN read_by_admin")
+            except sqlite3.OperationalError:
+                # SQLite before 3.35 cannot drop columns; the unused column keeps its default
+                pass
+
+    def _rebuild_inbox(self, conn):
+        conn.execute("DELETE FROM inbox")
+        for row in conn.execute("SELECT user_id, last_updated, read_seq FROM chats").fetchall():
+            _inbox_replace_chat(conn, row["user_id"], row["last_updated"], self.load_messages(row["user_id"]),
+                                row["read_seq"])
+
+    def _archived_records(self, conn):
+        """Yield (user_id, record) for every archived message, reading each segment once"""
+        for segment in conn.execute("SELECT user_id, file_name FROM archive_segments ORDER BY user_id, first_seq"):
+            for record in _read_segment(f"{self._archive_path(segment['user_id'])}/{segment['file_name']}"):
+                yield segment["user_id"], record
+
+    def _rebuild_media_refs(self, conn):
+        _clear_media_tables(conn)
+        for row in conn.execute("SELECT user_id, created_at, payload FROM messages").fetchall():
+            _media_ref_add(conn, row["user_id"], decode_message(json_loads(row["payload"])), row["created_at"],
+                           require_file=False)
+        for user_id, record in list(self._archived_records(conn)):
+            _media_ref_add(conn, user_id, record["message"], record.get("at", ""), require_file=False)
+
+    def _rebuild_search(self, conn):
+        conn.execute("DELETE FROM search_docs")
+        for user_id, record in list(self._archived_records(conn)):
+            _search_add(conn, user_id, record.get("seq", 0), record["message"])
+        for row in conn.execute("SELECT user_id, seq, payload FROM messages ORDER BY user_id, seq"):
+            _search_add(conn, row["user_id"], row["seq"], decode_message(json_loads(row["payload"])))
+
+    def rebuild_inbox_index(self):
+        """Rebuild the inbox, media reference, search and archive tables from the messages table and archive"""
+        conn = self._connect()
+        with _immediate_transaction(conn):
+            self._rebuild_archive_index(conn, [row["user_id"] for row in conn.execute("SELECT user_id FROM chats")])
+            self._rebuild_inbox(conn)
+            self._rebuild_media_refs(conn)
+            self._rebuild_search(conn)
+
+    def _message_from_row(self, row):
+        message = decode_message(json_loads(row["payload"]))
+        message["seq"] = row["seq"]
+        return message
+
+    def apply_batch(self, ops):
+        conn = self._connect()
+        try:
+            # The whole group is committed by one transaction
+            with _immediate_transaction(conn):
+                for op in ops:
+                    self._apply(conn, op)
+            return [None] * len(ops)
+        except Exception:
+            # Retry one by one so that a single bad operation does not fail the others
+            results = []
+            for op in ops:
+                try:
+                    with _immediate_transaction(conn):
+                        self._apply(conn, op)
+                    results.append(None)
+                except Exception as e:
+                    results.append(e)
+            return results
+
+    def _apply(self, conn, op):
+        kind, user_id, message = op
+        now = datetime.now().isoformat()
+
+        if kind == "append":
+            conn.execute(
+                "INSERT INTO chats (user_id, created_at, last_updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET last_updated = excluded.last_updated",
+                (user_id, now, now))
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) + 1 FROM messages WHERE user_id = ?", (user_id,)).fetchone()[0]
+            with timed("json_dump"):
+                payload = json_dumps(encode_message(message))
+            conn.execute(
+                "INSERT INTO messages (user_id, seq, message_id, sender, created_at, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, seq, message.get("message_id"), message.get("sender"), now, payload))
+            _inbox_record_message(conn, user_id, message, now)
+            _media_ref_add(conn, user_id, message, now)
+            _search_add(conn, user_id, seq, message)
+        elif kind == "update":
+            row = conn.execute("SELECT seq, payload FROM messages WHERE user_id = ? AND message_id = ?",
+                               (user_id, message["message_id"])).fetchone()
+            if row is not None:
+                payload = decode_message(json_loads(row["payload"]))
+                payload.update(message)
+                conn.execute("UPDATE messages SET payload = ? WHERE user_id = ? AND seq = ?",
+                             (json_dumps(encode_message(payload)), user_id, row["seq"]))
+        elif kind == "mark_read":
+            conn.execute(
+                "UPDATE chats SET read_seq = (SELECT COALESCE(MAX(seq), 0) FROM messages WHERE user_id = ?) "
+                "WHERE user_id = ?",
+                (user_id, user_id))
+            _inbox_mark_read(conn, user_id)
+        elif kind == "clear":
+            _media_ref_release(conn, user_id, [
+                decode_message(json_loads(row["payload"])) for row in conn.execute(
+                    "SELECT payload FROM messages WHERE user_id = ?", (user_id,))
+            ], now)
+            self._clear_archive(conn, user_id, now)
+            conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM chats WHERE user_id = ?", (user_id,))
+            _inbox_remove(conn, user_id)
+            _search_remove(conn, user_id)
+
+    def _load_hot_messages(self, user_id):
+        rows = self._connect().execute(
+            "SELECT seq, payload FROM messages WHERE user_id = ? ORDER BY seq", (user_id,)).fetchall()
+        with timed("json_parse"):
+            return [self._message_from_row(row) for row in rows]
+
+    def _load_hot_page(self, user_id, before_seq, after_seq, limit):
+        conn = self._connect()
+        # Both bounds and the limit are served by the (user_id, seq) primary key
+        rows = conn.execute(
+            "SELECT seq, payload FROM messages WHERE user_id = ? AND seq > ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+            (user_id, after_seq, before_seq if before_seq is not None else 2 ** 63 - 1,
+             limit if limit is not None else -1)).fetchall()
+        with timed("json_parse"):
+            messages = [self._message_from_row(row) for row in reversed(rows)]
+        if not messages:
+            return [], None
+
+        first_seq = conn.execute("SELECT MIN(seq) FROM messages WHERE user_id = ?", (user_id,)).fetchone()[0]
+        return messages, (messages[0]["seq"] if messages[0]["seq"] > first_seq else None)
+
+    def archive_chat(self, user_id):
+        conn = self._connect()
+        hot_messages = self.retention_policy(user_id)["hot_messages"]
+        with _immediate_transaction(conn):
+            rows = conn.execute(
+                "SELECT seq, created_at, payload FROM messages WHERE user_id = ? ORDER BY seq", (user_id,)).fetchall()
+            with timed("json_parse"):
+                records = [{"op": "message", "seq": row["seq"], "at": row["created_at"],
+                            "message": decode_message(json_loads(row["payload"]))} for row in rows]
+            count = _archivable_count([record["message"] for record in records], hot_messages)
+            if count:
+                self._archive_records(conn, user_id, records[:count])
+                conn.execute("DELETE FROM messages WHERE user_id = ? AND seq <= ?",
+                             (user_id, records[count - 1]["seq"]))
+        return count
+
+    def list_chats(self):
+        return _inbox_list(self._connect())
+
+    def _index_db(self):
+        return self._connect()
+
+
+@st.cache_resource
+def get_chat_store():
+    """Return the configured chat store, shared by all sessions"""
+    if CHAT_STORE_BACKEND == "sqlite":
+        return SqliteChatStore(CHAT_DB_PATH)
+    return JsonChatStore(PRIVATE_CHATS_DIR)
+
+
+class ChangeNotifier:
+    """Per-key version counters that sessions block on until something they watch changes"""
+
+    def __init__(self):
+        self._versions = {}
+        self._condition = threading.Condition()
+        self.feed = None
+
+    def bump(self, *keys, publish=True):
+        """Move the keys' versions, and unless they came from it, tell other processes through the change feed"""
+        with self._condition:
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+            self._condition.notify_all()
+        if publish and self.feed is not None:
+            self.feed.publish(keys)
+
+    def snapshot(self, keys):
+        with self._condition:
+            return {key: self._versions.get(key, 0) for key in keys}
+
+    def wait(self, seen_versions, timeout):
+        """Wait until any watched key moves past its seen version, returning whether one did"""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: any(self._versions.get(key, 0) != version for key, version in seen_versions.items()),
+                timeout)
+
+
+@st.cache_resource
+def get_change_notifier():
+    """Return the change notifier shared by all sessions in this process"""
+    return ChangeNotifier()
+
+
+class ChangeFeed:
+    """Background thread that relays change keys between the processes sharing a chat store"""
+
+    def __init__(self, store, notifier, interval=CHANGE_FEED_POLL_INTERVAL):
+        self.store = store
+        self.notifier = notifier
+        self.interval = interval
+        # Distinguishes this process's entries, which its notifier has already seen
+        self.origin = uuid4().hex
+        self.last_id = store.last_change_id()
+        self._last_prune = time.time()
+        self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+        self._thread.start()
+
+    def publish(self, keys):
+        try:
+            self.store.publish_changes(keys, self.origin)
+        except Exception:
+            count_error("change_feed_publish")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll_once()
+            except Exception:
+                count_error("change_feed")
+
+    def poll_once(self):
+        """Bump the keys other processes changed since the last poll, returning how many there were"""
+        rows = self.store.read_changes(self.last_id)
+        if rows:
+            self.last_id = rows[-1]["id"]
+        changed_keys = {row["change_key"] for row in rows if row["origin"] != self.origin}
+        if changed_keys:
+            self.notifier.bump(*changed_keys, publish=False)
+
+        if time.time() - self._last_prune > CHANGE_FEED_PRUNE_INTERVAL:
+            self.store.prune_changes()
+            self._last_prune = time.time()
+        return len(changed_keys)
+
+
+@st.cache_resource
+def start_change_feed():
+    """Connect this process's change notifier to the shared change feed, or return None when it is disabled"""
+    if not CHANGE_FEED_POLL_INTERVAL:
+        return None
+    notifier = get_change_notifier()
+    notifier.feed = ChangeFeed(get_chat_store(), notifier)
+    return notifier.feed
+
+
+@contextmanager
+def maintenance_lock(name):
+    """Try to take the lock for one kind of maintenance pass, yielding whether this process holds it"""
+    if fcntl is None:
+        yield True
+        return
+
+    if not os.path.exists(MAINTENANCE_LOCK_DIR):
+        os.makedirs(MAINTENANCE_LOCK_DIR)
+    with open(f"{MAINTENANCE_LOCK_DIR}/.{name}.lock", "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def chat_change_key(user_id):
+    return f"chat:{user_id}"
+
+
+class ReadCache:
+    """Read-through cache of store queries, valid while the change versions it was loaded at still hold
+
+    Concurrent misses on one key are loaded once. Cached values are shared between sessions and must not be mutated.
+    Loads are timed under a span named after the first element of their key.
+    """
+
+    def __init__(self, notifier, max_entries=READ_CACHE_ENTRIES, max_age=READ_CACHE_MAX_AGE):
+        self.notifier = notifier
+        self.max_age = max_age
+        self._entries = LruCache(max_entries)
+        self._locks = [threading.Lock() for _ in range(READ_CACHE_LOCK_STRIPES)]
+
+    def _fresh(self, entry, version):
+        return entry is not None and entry[0] == version and time.monotonic() - entry[1] < self.max_age
+
+    def get(self, key, change_keys, load):
+        """Return the cached value for key, calling load() when a change key has moved since it was cached"""
+        # Versions are read before loading, so a write that lands during the load invalidates the result
+        version = tuple(self.notifier.snapshot(change_keys).values())
+        entry = self._entries.get(key)
+        if self._fresh(entry, version):
+            return entry[2]
+
+        with self._locks[hash(key) % len(self._locks)]:
+            entry = self._entries.get(key)
+            if self._fresh(entry, version):
+                # Loaded by another session while this one waited
+                return entry[2]
+            with timed(f"store_read_{key[0]}"):
+                value = load()
+            self._entries.put(key, (version, time.monotonic(), value))
+            return value
+
+
+@st.cache_resource
+def get_read_cache():
+    """Return the store read cache shared by all sessions in this process"""
+    return ReadCache(get_change_notifier())
+
+
+class ChatWriter:
+    """Single background writer that applies chat mutations in order and commits them in groups
+
+    Operations queued while a group is being written are committed together by the next group,
+    so a burst of sends costs one flush per chat rather than one per message.
+    """
+
+    def __init__(self, store, notifier):
+        self.store = store
+        self.notifier = notifier
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, kind, user_id, message=None):
+        """Queue a mutation and return a Future that resolves once it is stored"""
+        future = Future()
+        self._queue.put(((kind, user_id, message), future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < GROUP_COMMIT_MAX_OPS:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with timed("store_write"):
+                results = self.store.apply_batch([op for op, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+
+        changed_keys = set()
+        for (op, _), error in zip(batch, results):
+            if error is None:
+                kind, user_id, _ = op
+                changed_keys.add(INBOX_CHANGE_KEY)
+                if kind != "mark_read":
+                    changed_keys.add(chat_change_key(user_id))
+
+        # Bumped before the writers are released, so a rerun they trigger never reads a stale cached page
+        if changed_keys:
+            self.notifier.bump(*changed_keys)
+
+        for (_, future), error in zip(batch, results):
+            if error is None:
+                future.set_result(True)
+            else:
+                future.set_exception(error)
+
+
+@st.cache_resource
+def get_chat_writer():
+    """Return the writer that serializes all chat mutations in this process"""
+    return ChatWriter(get_chat_store(), get_change_notifier())
+
+
+class MediaProcessor:
+    """Runs image processing in worker processes and stores each result on its message through the writer"""
+
+    def __init__(self, writer, max_workers=MEDIA_WORKERS):
+        self.writer = writer
+        self.max_workers = max_workers
+        self._pool = self._new_pool()
+        self._in_flight = set()
+        self._broken_attempts = Counter()
+        self._lock = threading.Lock()
+
+    def _new_pool(self):
+        # Workers are spawned rather than forked, since this process runs server and writer threads
+        return ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, user_id, message):
+        """Queue a message's media for processing unless it is already queued"""
+        message_id = message["message_id"]
+        with self._lock:
+            if message_id in self._in_flight:
+                return
+            self._in_flight.add(message_id)
+
+        media_key = message.get("media_sha256") or message_id
+        try:
+            try:
+                future = self._pool.submit(_process_image_timed, message["media_path"], media_key)
+            except BrokenProcessPool:
+                # A worker died, for example killed while decoding; start over with a fresh pool
+                self._pool = self._new_pool()
+                future = self._pool.submit(_process_image_timed, message["media_path"], media_key)
+        except Exception:
+            self._done(message_id)
+            raise
+        future.add_done_callback(lambda done: self._finish(user_id, message_id, done))
+
+    def _finish(self, user_id, message_id, future):
+        try:
+            fields, timings = future.result()
+            if METRICS_ENABLED:
+                for span, seconds in timings.items():
+                    get_metrics().observe(span, seconds)
+        except BrokenProcessPool:
+            with self._lock:
+                self._broken_attempts[message_id] += 1
+                attempts = self._broken_attempts[message_id]
+            if attempts < MEDIA_MAX_BROKEN_ATTEMPTS:
+                # Possibly not the image's fault; it is processed again the next time it is shown
+                self._done(message_id)
+                return
+            count_error("process_image")
+            fields = {"media_status": "failed"}
+        except Exception:
+            count_error("process_image")
+            fields = {"media_status": "failed"}
+        with self._lock:
+            self._broken_attempts.pop(message_id, None)
+        self.writer.submit("update", user_id, {**fields, "message_id": message_id}).add_done_callback(
+            lambda _: self._done(message_id))
+
+    def _done(self, message_id):
+        with self._lock:
+            self._in_flight.discard(message_id)
+
+
+@st.cache_resource
+def get_media_processor():
+    """Return the media worker pool shared by all sessions"""
+    return MediaProcessor(get_chat_writer())
+
+
+def needs_media_processing(message):
+    """Check whether an image message still lacks the renditions it is shown with"""
+    if message.get("media_type") != "image" or not message.get("media_path"):
+        return False
+    if message.get("media_status") == "failed":
+        return False
+    thumbnail_path = (message.get("thumbnails") or {}).get(str(THUMBNAIL_MAX_WIDTH))
+    return thumbnail_path is None or not os.path.exists(thumbnail_path)
+
+
+def schedule_media_processing(user_id, message):
+    """Hand an image message to the media workers; messages sent before processing existed are caught up too"""
+    try:
+        if not needs_media_processing(message):
+            return
+        if os.path.exists(message["media_path"]):
+            get_media_processor().submit(user_id, message)
+        elif message.get("media_status") == "processing":
+            # Nothing left to process; otherwise the chat is re-read from this message on every rerun
+            get_chat_writer().submit("update", user_id, {"message_id": message["message_id"], "media_status": "failed"})
+    except Exception:
+        count_error("schedule_media_processing")
+
+
+def _sweep_staged_uploads():
+    """Delete staged uploads abandoned long ago, for example by a session that was closed mid-upload"""
+    cutoff = time.time() - UPLOAD_STAGING_MAX_AGE
+    try:
+        for entry in os.scandir(UPLOAD_STAGING_DIR):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+    except FileNotFoundError:
+        pass
+
+
+class MediaCollector:
+    """Background thread that reclaims media no chat references, a small batch per pass, while the app runs"""
+
+    def __init__(self, store, notifier, interval=MEDIA_GC_INTERVAL):
+        self.store = store
+        self.notifier = notifier
+        self.interval = interval
+        self.reclaimed_files = 0
+        self.reclaimed_bytes = 0
+        self._directories = []
+        self._thread = threading.Thread(target=self._run, name="media-collector", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with maintenance_lock("media_collector") as acquired:
+                    if acquired:
+                        self.run_once()
+            except Exception:
+                count_error("media_collector")
+
+    def run_once(self):
+        """Collect one batch of unreferenced files and sweep one media directory for untracked ones"""
+        files, size = self.store.collect_media()
+
+        if not self._directories:
+            # Each pass sweeps the next directory; the list is refilled once all have been visited
+            try:
+                self._directories = [MEDIA_DIR] + [
+                    f"{MEDIA_DIR}/{entry.name}" for entry in os.scandir(MEDIA_DIR)
+                    if entry.is_dir() and f"{MEDIA_DIR}/{entry.name}" != UPLOAD_STAGING_DIR]
+            except FileNotFoundError:
+                self._directories = []
+        if self._directories:
+            swept_files, swept_size = self.store.sweep_media_directory(self._directories.pop())
+            files += swept_files
+            size += swept_size
+        _sweep_staged_uploads()
+
+        self.reclaimed_files += files
+        self.reclaimed_bytes += size
+        if files:
+            self.notifier.bump(MEDIA_CHANGE_KEY)
+        return files, size
+
+
+@st.cache_resource
+def start_media_collector():
+    """Start the media collector once per process, or return None when it is disabled"""
+    if not MEDIA_GC_INTERVAL:
+        return None
+    return MediaCollector(get_chat_store(), get_change_notifier())
+
+
+class ChatArchiver:
+    """Background thread that moves the oldest messages of long chats into the archive and expires old segments"""
+
+    def __init__(self, store, notifier, interval=CHAT_ARCHIVE_INTERVAL):
+        self.store = store
+        self.notifier = notifier
+        self.interval = interval
+        self.archived_messages = 0
+        self.expired_messages = 0
+        self._thread = threading.Thread(target=self._run, name="chat-archiver", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with maintenance_lock("chat_archiver") as acquired:
+                    if acquired:
+                        self.run_once()
+            except Exception:
+                count_error("chat_archiver")
+
+    def run_once(self):
+        """Archive a batch of chats and delete the segments past their retention, returning both message counts"""
+        archived = 0
+        for user_id in self.store.archive_candidates():
+            try:
+                archived += self.store.archive_chat(user_id)
+            except Exception:
+                count_error("archive_chat")
+        removed = self.store.expire_archives()
+
+        self.archived_messages += archived
+        self.expired_messages += sum(removed.values())
+        if removed:
+            # Archiving leaves every page unchanged; expiry removes messages
+            self.notifier.bump(INBOX_CHANGE_KEY, *(chat_change_key(user_id) for user_id in removed))
+        return archived, sum(removed.values())
+
+
+@st.cache_resource
+def start_chat_archiver():
+    """Start the chat archiver once per process, or return None when it is disabled"""
+    if not CHAT_ARCHIVE_INTERVAL:
+        return None
+    return ChatArchiver(get_chat_store(), get_change_notifier())
+
+
+def get_media_usage():
+    """Get stored media totals and the chats using the most media"""
+    try:
+        # Media is charged on every save and clear, which move the inbox key, and freed by the collector
+        return get_read_cache().get(("media_usage",), [INBOX_CHANGE_KEY, MEDIA_CHANGE_KEY],
+                                    get_chat_store().media_usage)
+    except Exception:
+        count_error("get_media_usage")
+        return None
+
+
+def save_private_chat_message(user_id, message):
+    """Save message to specific user's private chat with admin, returning whether it was stored"""
+    try:
+        return get_chat_writer().submit("append", user_id, message).result(timeout=WRITE_ACK_TIMEOUT)
+    except Exception:
+        count_error("save_private_chat_message")
+        return False
 
 
 def load_private_chat(user_id):
     """Load private chat messages for specific user"""
     try:
-        chat_file = f"database/private_chats/{user_id}.json"
-
-        if os.path.exists(chat_file):
-            with open(chat_file, "r") as f:
-                chat_data = json.load(f)
-            return chat_data.get("messages", [])
+        with timed("store_read_history"):
+            return get_chat_store().load_messages(user_id)
+    except Exception:
+        count_error("load_private_chat")
         return []
+
+
+def load_chat_page(user_id, before_seq=None, after_seq=0, limit=CHAT_PAGE_SIZE):
+    """Load one window of a chat's history and the cursor for the page before it"""
+    try:
+        return get_read_cache().get(
+            ("chat_page", user_id, before_seq, after_seq, limit), [chat_change_key(user_id)],
+            lambda: get_chat_store().load_page(user_id, before_seq=before_seq, after_seq=after_seq, limit=limit))
+    except Exception:
+        count_error("load_chat_page")
+        return [], None
+
+
+def load_chat_history(user_id):
+    """Return the messages this session shows for a chat, fetching only those newer than it has seen"""
+    cache = st.session_state.chat_cache
+    if cache.get("user_id") == user_id and cache["messages"]:
+        # Re-reading from the newest cached message confirms the chat was not cleared in the meantime;
+        # reading from the oldest message still being processed also picks up its finished media
+        cached = cache["messages"]
+        start = next((i for i, message in enumerate(cached) if message.get("media_status") == "processing"),
+                     len(cached) - 1)
+        newer_messages, _ = load_chat_page(user_id, after_seq=cached[start]["seq"] - 1, limit=None)
+        if newer_messages and newer_messages[0].get("message_id") == cached[start].get("message_id"):
+            cached[start:] = newer_messages
+            return cached, cache["older_cursor"]
+
+    messages, older_cursor = load_chat_page(user_id)
+    # A copy, since pages are shared with other sessions and this list grows in place
+    messages = list(messages)
+    st.session_state.chat_cache = {"user_id": user_id, "messages": messages, "older_cursor": older_cursor}
+    return messages, older_cursor
+
+
+def show_load_older_button(user_id, older_cursor):
+    """Offer to extend the shown history by one page of older messages"""
+    if older_cursor is None:
+        return
+    if st.button("⬆️ Load older messages", key=f"load_older_{user_id}"):
+        cache = st.session_state.chat_cache
+        older_messages, cache["older_cursor"] = load_chat_page(user_id, before_seq=older_cursor)
+        cache["messages"][:0] = older_messages
+        st.rerun()
+
+
+def extend_chat_history(user_id, seq):
+    """Extend the session's cached history back far enough to show a message and a few before it"""
+    cache = st.session_state.chat_cache
+    if cache.get("user_id") != user_id or cache["older_cursor"] is None or cache["older_cursor"] <= seq:
+        return
+    older_messages, cache["older_cursor"] = load_chat_page(
+        user_id, before_seq=cache["older_cursor"], after_seq=max(seq - SEARCH_CONTEXT_MESSAGES, 0) - 1, limit=None)
+    cache["messages"][:0] = older_messages
+
+
+def get_retention_policy(user_id):
+    """Get a chat's retention policy and the size of its archive"""
+    try:
+        store = get_chat_store()
+        return {**store.retention_policy(user_id), **store.archive_stats(user_id)}
+    except Exception:
+        count_error("get_retention_policy")
+        return None
+
+
+def set_retention_policy(user_id, hot_messages, retention_days):
+    """Change how much of a chat stays unarchived and how long its archive is kept, returning whether it was saved"""
+    try:
+        get_chat_store().set_retention_policy(user_id, hot_messages, retention_days)
+        return True
     except Exception:
+        count_error("set_retention_policy")
+        return False
+
+
+def search_messages(query):
+    """Search every conversation, returning ranked hits"""
+    try:
+        return get_read_cache().get(("search", query), [INBOX_CHANGE_KEY],
+                                    lambda: get_chat_store().search_messages(query))
+    except Exception:
+        count_error("search_messages")
         return []
 
 
-def get_all_user_chats():
-    """Get list of all users who have chatted with admin"""
+def get_inbox_page(unread_only=False, active_since=None, sort="Most recent", page=0):
+    """Get one page of conversations for the admin inbox and the number matching the filters"""
     try:
-        if not os.path.exists("database/private_chats"):
-            return []
+        return get_read_cache().get(
+            ("inbox_page", unread_only, active_since, sort, page), [INBOX_CHANGE_KEY],
+            lambda: get_chat_store().list_chats_page(unread_only, active_since, sort, INBOX_PAGE_SIZE,
+                                                     page * INBOX_PAGE_SIZE))
+    except Exception:
+        count_error("get_inbox_page")
+        return [], 0
 
-        user_chats = []
-        for filename in os.listdir("database/private_chats"):
-            if filename.endswith(".json"):
-                user_id = filename[:-5]  # Remove .json extension
-                try:
-                    with open(f"database/private_chats/{filename}", "r") as f:
-                        chat_data = json.load(f)
 
-                    # Get last message info
-                    messages = chat_data.get("messages", [])
-                    last_message = messages[-1] if messages else None
-                    unread_count = sum(
-                        1 for msg in messages if msg.get("sender") != "admin" and not msg.get("read_by_admin", False))
+def get_inbox_stats():
+    """Get the number of conversations and of unread messages"""
+    try:
+        return get_read_cache().get(("inbox_stats",), [INBOX_CHANGE_KEY], get_chat_store().inbox_stats)
+    except Exception:
+        count_error("get_inbox_stats")
+        return {"chat_count": 0, "unread_count": 0}
 
-                    user_chats.append({
-                        "user_id": user_id,
-                        "last_updated": chat_data.get("last_updated", ""),
-                        "message_count": len(messages),
-                        "last_message": last_message,
-                        "unread_count": unread_count
-                    })
-                except:
-                    continue
 
-        # Sort by last updated (most recent first)
-        user_chats.sort(key=lambda x: x["last_updated"], reverse=True)
-        return user_chats
+def get_all_user_chats():
+    """Get list of all users who have chatted with admin"""
+    try:
+        return get_read_cache().get(("all_chats",), [INBOX_CHANGE_KEY], get_chat_store().list_chats)
     except Exception:
+        count_error("get_all_user_chats")
         return []
 
 
 def mark_messages_as_read(user_id):
     """Mark all user messages as read by admin"""
     try:
-        chat_file = f"database/private_chats/{user_id}.json"
-        if os.path.exists(chat_file):
-            with open(chat_file, "r") as f:
-                chat_data = json.load(f)
-
-            # Mark all user messages as read
-            for message in chat_data["messages"]:
-                if message.get("sender") != "admin":
-                    message["read_by_admin"] = True
-
-            with open(chat_file, "w") as f:
-                json.dump(chat_data, f, indent=2)
+        get_chat_writer().submit("mark_read", user_id).result(timeout=WRITE_ACK_TIMEOUT)
     except Exception:
-        pass
+        count_error("mark_messages_as_read")
 
 
 def clear_user_chat(user_id):
     """Clear specific user's chat"""
     try:
-        chat_file = f"database/private_chats/{user_id}.json"
-        if os.path.exists(chat_file):
-            os.remove(chat_file)
+        # Media the chat used is released here and deleted by the media collector once nothing else uses it
+        get_chat_writer().submit("clear", user_id).result(timeout=WRITE_ACK_TIMEOUT)
     except Exception:
-        pass
+        count_error("clear_user_chat")
+
+
+def watched_change_keys():
+    """Return the change keys whose updates should refresh the current view"""
+    if not st.session_state.is_admin:
+        return [chat_change_key(st.session_state.current_user)]
+    if st.session_state.admin_view_mode == "chat" and st.session_state.selected_user_chat:
+        return [chat_change_key(st.session_state.selected_user_chat), INBOX_CHANGE_KEY]
+    return [INBOX_CHANGE_KEY]
+
+
+def wait_for_changes(seen_versions):
+    """Block until a watched chat changes, falling back to an idle refresh that backs off over time"""
+    notifier = get_change_notifier()
+    deadline = time.time() + st.session_state.idle_refresh_interval
+
+    while time.time() < deadline:
+        if notifier.wait(seen_versions, timeout=min(CHANGE_WAIT_SLICE, max(deadline - time.time(), 0))):
+            st.session_state.idle_refresh_interval = st.session_state.auto_refresh_time
+            st.rerun()
+        # Touching session state lets Streamlit interrupt the wait as soon as the user interacts
+        st.session_state.last_refresh = time.time()
+
+    # Nothing changed: refresh in case another process wrote, then wait twice as long next time
+    st.session_state.idle_refresh_interval = min(st.session_state.idle_refresh_interval * 2,
+                                                 IDLE_REFRESH_MAX_SECONDS)
+    st.session_state.idle_rerun = True
+    st.rerun()
+
+
+def start_profiling(mode, reruns):
+    """Profile this session's next reruns with cProfile or the stack sampler"""
+    st.session_state.profile = {
+        "mode": mode,
+        "reruns_left": reruns,
+        "reruns_profiled": 0,
+        "profiler": cProfile.Profile() if mode == "cProfile" else None,
+        "stacks": Counter()
+    }
+
+
+def _cprofile_top_functions(profiler):
+    stats = pstats.Stats(profiler).stats
+    ranked = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+    return [{
+        "function": f"{function} ({os.path.basename(file_name)}:{line})",
+        "calls": calls,
+        "own ms": round(own_time * 1000, 2),
+        "total ms": round(total_time * 1000, 2)
+    } for (file_name, line, function), (_, calls, own_time, total_time, _) in ranked]
+
+
+def _sampled_top_functions(stacks):
+    samples = sum(stacks.values())
+    own, total = Counter(), Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        # Recursive functions are counted once per stack
+        for label in set(stack):
+            total[label] += count
+    return [{
+        "function": label,
+        "samples": count,
+        "own %": round(count * 100 / samples, 1),
+        "total %": round(total[label] * 100 / samples, 1)
+    } for label, count in own.most_common(PROFILE_TOP_FUNCTIONS)]
+
+
+def save_profile(profile):
+    """Write a finished profile to the profile directory and return its summary for display"""
+    path = (f"{PROFILE_DIR}/{datetime.now():%Y%m%d-%H%M%S}-{st.session_state.current_user}-"
+            f"{uuid4().hex[:8]}.{'pstats' if profile['mode'] == 'cProfile' else 'collapsed'}")
+    summary = {"mode": profile["mode"], "reruns": profile["reruns_profiled"], "path": None}
+    if profile["mode"] == "cProfile":
+        summary["top"] = _cprofile_top_functions(profile["profiler"])
+    else:
+        summary["top"] = _sampled_top_functions(profile["stacks"])
+
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if profile["mode"] == "cProfile":
+            profile["profiler"].dump_stats(path)
+        else:
+            # One "root;...;leaf count" line per stack, as read by flamegraph.pl and speedscope
+            with open(path, "w") as f:
+                for stack, count in profile["stacks"].items():
+                    f.write(f"{';'.join(stack)} {count}\n")
+        summary["path"] = path
+    except OSError:
+        count_error("save_profile")
+    return summary
+
+
+@contextmanager
+def profile_rerun():
+    """Profile the enclosed part of this rerun when the admin asked for it, saving the report after the last one"""
+    profile = st.session_state.profile
+    if not profile or not st.session_state.is_admin or (
+            profile["mode"] == "cProfile" and not get_profiler_lock().acquire(blocking=False)):
+        # Another session holding cProfile just delays this one's profile by a rerun
+        yield
+        return
+
+    sampler = None
+    if profile["mode"] == "cProfile":
+        profile["profiler"].enable()
+    else:
+        sampler = StackSampler(threading.get_ident(), profile["stacks"])
+        sampler.start()
+    try:
+        yield
+    finally:
+        if sampler is None:
+            profile["profiler"].disable()
+            get_profiler_lock().release()
+        else:
+            sampler.stop()
+
+        profile["reruns_profiled"] += 1
+        profile["reruns_left"] -= 1
+        if profile["reruns_left"] <= 0:
+            st.session_state.profile = None
+            st.session_state.last_profile = save_profile(profile)
+
+    if st.session_state.get("profile") is None:
+        # The sidebar was drawn while the profile was still running; show its results
+        st.rerun()
 
 
 def initialize_session():
@@ -196,8 +3100,70 @@ def initialize_session():
         st.session_state.auto_refresh_time = 3
     if "last_refresh" not in st.session_state:
         st.session_state.last_refresh = time.time()
+    if "idle_refresh_interval" not in st.session_state:
+        st.session_state.idle_refresh_interval = st.session_state.auto_refresh_time
+    if "idle_rerun" not in st.session_state:
+        st.session_state.idle_rerun = False
+    if "chat_cache" not in st.session_state:
+        st.session_state.chat_cache = {}
+    if "staged_upload" not in st.session_state:
+        st.session_state.staged_upload = None
+    if "highlight_message" not in st.session_state:
+        st.session_state.highlight_message = None
+    if "inbox_page" not in st.session_state:
+        st.session_state.inbox_page = 0
     if "auto_refresh_enabled" not in st.session_state:
         st.session_state.auto_refresh_enabled = True
+    if "profile" not in st.session_state:
+        st.session_state.profile = None
+    if "last_profile" not in st.session_state:
+        st.session_state.last_profile = None
+    if not st.session_state.is_authenticated:
+        resume_login()
+
+
+def remember_login():
+    """Record this session's login in the shared store and put the token that resumes it in the page URL"""
+    if not SESSION_URL_TOKENS:
+        return
+    try:
+        st.query_params[SESSION_QUERY_PARAM] = get_chat_store().create_session(
+            st.session_state.current_user, st.session_state.is_admin)
+    except Exception:
+        count_error("remember_login")
+
+
+def resume_login():
+    """Sign a new session back in from the token in its URL, e.g. after reconnecting to another replica"""
+    token = st.query_params.get(SESSION_QUERY_PARAM)
+    if not token:
+        return
+    if not SESSION_URL_TOKENS:
+        del st.query_params[SESSION_QUERY_PARAM]
+        return
+    try:
+        login = get_chat_store().rotate_session(token)
+    except Exception:
+        count_error("resume_login")
+        return
+    if login is None:
+        del st.query_params[SESSION_QUERY_PARAM]
+        return
+    # The used token is revoked, so one copied from the browser history or a log no longer signs anyone in
+    st.query_params[SESSION_QUERY_PARAM], st.session_state.current_user, st.session_state.is_admin = login
+    st.session_state.is_authenticated = True
+
+
+def forget_login():
+    """End the login behind this session's URL token"""
+    token = st.query_params.get(SESSION_QUERY_PARAM)
+    if not token:
+        return
+    try:
+        get_chat_store().end_session(token)
+    except Exception:
+        count_error("forget_login")
+    del st.query_params[SESSION_QUERY_PARAM]
 
 
 def authenticate_user(username, password=None):
@@ -220,14 +3186,15 @@ def authenticate_user(username, password=None):
             return False, False  # no username provided
 
 
-def display_media_message(message, is_sender):
-    """Display a message with media content"""
-    content = message.get("content", "")
-    timestamp = message.get("timestamp", "")
-    sender = message.get("sender", "")
+def media_message_html(message, is_sender):
+    """Build the HTML for a message with media content"""
+    # Everything the sender controls is escaped, since fragments are rendered as HTML
+    content = escape(message.get("content", ""))
+    timestamp = escape(message.get("timestamp", ""))
+    sender = escape(message.get("sender", ""))
     media_path = message.get("media_path", "")
     media_type = message.get("media_type", "")
-    original_filename = message.get("original_filename", "")
+    original_filename = escape(message.get("original_filename", ""))
 
     alignment = "message-row-right" if is_sender else "message-row-left"
     sender_name = "You" if is_sender else ("Admin" if sender == "admin" else sender)
@@ -235,52 +3202,90 @@ def display_media_message(message, is_sender):
 
     media_html = ""
 
-    if media_path and os.path.exists(media_path):
-        if media_type == "image":
+    # Content-addressed media shares one set of renditions between every message that sends it
+    media_key = message.get("media_sha256") or message.get("message_id", "")
+
+    if media_path and not os.path.exists(media_path):
+        invalidate_thumbnail(media_key)
+    elif media_path:
+        thumbnails = message.get("thumbnails") or {}
+        thumbnail_path = thumbnails.get(str(THUMBNAIL_MAX_WIDTH))
+
+        if media_type == "image" and message.get("media_status") == "failed":
+            media_html = f'<div style="color: #ff6b6b;">Could not process image: {original_filename}</div>'
+
+        elif media_type == "image" and (thumbnail_path is None or not os.path.exists(thumbnail_path)):
+            # Shown until a media worker has written the thumbnails
+            media_html = f'''
+            <div style="margin: 8px 0; padding: 24px; background: rgba(0,0,0,0.1); border-radius: 8px;
+                        text-align: center; color: #888;">
+                ⏳ Processing image…
+                <div style="font-size: 0.75em; margin-top: 4px;">📷 {original_filename}</div>
+            </div>
+            '''
+
+        elif media_type == "image":
             try:
-                # Display image
-                image = Image.open(media_path)
-                # Resize if too large
-                max_width = 400
-                if image.width > max_width:
-                    ratio = max_width / image.width
-                    new_height = int(image.height * ratio)
-                    image = image.resize((max_width, new_height), Image.Resampling.LANCZOS)
-
-                # Convert to base64 for display
-                buffered = io.BytesIO()
-                image.save(buffered, format="PNG")
-                img_str = base64.b64encode(buffered.getvalue()).decode()
+                # Display the thumbnail, linked to the display copy or, for small clean images, the original
+                display_path = message.get("display_path")
+                full_size_url = (media_url("thumbnails", display_path) if display_path
+                                 else media_url("media", media_path))
+                if full_size_url:
+                    thumbnail_src = media_url("thumbnails", thumbnail_path)
+                    srcset = ", ".join(f"{media_url('thumbnails', path)} {size}w"
+                                       for size, path in sorted(thumbnails.items(), key=lambda item: int(item[0])))
+                    image_html = f'''
+                    <a href="{full_size_url}" target="_blank" title="Click to view full size">
+                        <img src="{thumbnail_src}" srcset="{srcset}" sizes="{THUMBNAIL_MAX_WIDTH}px" loading="lazy"
+                             style="max-width: 100%; border-radius: 8px; cursor: pointer;">
+                    </a>'''
+                else:
+                    with open(thumbnail_path, "rb") as f:
+                        thumbnail = f.read()
+                    img_str = base64.b64encode(thumbnail).decode()
+                    image_html = f'''
+                    <img src="data:image/{THUMBNAIL_FORMAT.lower()};base64,{img_str}"
+                         style="max-width: 100%; border-radius: 8px; cursor: pointer;"
+                         onclick="window.open(this.src, '_blank')"
+                         title="Click to view full size">'''
 
                 media_html = f'''
                 <div style="margin: 8px 0;">
-                    <img src="data:image/png;base64,{img_str}" 
-                         style="max-width: 100%; border-radius: 8px; cursor: pointer;"
-                         onclick="window.open('data:image/png;base64,{img_str}', '_blank')"
-                         title="Click to view full size">
+                    {image_html}
                     <div style="font-size: 0.75em; color: #888; margin-top: 4px;">📷 {original_filename}</div>
                 </div>
                 '''
-            except Exception as e:
+            except Exception:
+                count_error("media_message_html")
                 media_html = f'<div style="color: #ff6b6b;">Error loading image: {original_filename}</div>'
 
         elif media_type == "video":
             try:
                 file_size = get_file_size_mb(media_path)
+                video_url = media_url("media", media_path)
+                if video_url:
+                    # The browser streams the video with Range requests, so only what is watched is sent
+                    player_html = f'''
+                    <video controls preload="metadata" src="{video_url}"
+                           style="max-width: 100%; border-radius: 8px; margin-top: 8px;"></video>
+                    <div style="font-size: 0.8em; margin-top: 4px;">
+                        <a href="{video_url}" download="{original_filename}">⬇️ Download</a>
+                    </div>'''
+                else:
+                    # Played by show_chat_messages right below this fragment
+                    player_html = ""
+
                 media_html = f'''
                 <div style="margin: 8px 0; padding: 12px; background: rgba(0,0,0,0.1); border-radius: 8px;">
                     <div style="font-size: 1.1em;">🎥 {original_filename}</div>
                     <div style="font-size: 0.85em; color: #666; margin-top: 4px;">
                         Video • {file_size:.1f} MB
                     </div>
-                    <div style="margin-top: 8px;">
-                        <em style="font-size: 0.8em; color: #888;">
-                            💡 Video files can be downloaded from the server directory: {media_path}
-                        </em>
-                    </div>
+                    {player_html}
                 </div>
                 '''
-            except Exception as e:
+            except Exception:
+                count_error("media_message_html")
                 media_html = f'<div style="color: #ff6b6b;">Error loading video: {original_filename}</div>'
 
     # Combine text and media
@@ -290,14 +3295,64 @@ def display_media_message(message, is_sender):
     if media_html:
         message_content += media_html
 
-    st.markdown(f"""
+    return f"""
     <div class="{alignment}">
         <div class="message-content">
             {message_content}
             <div class="message-time">🕐 {timestamp}</div>
         </div>
     </div>
-    """, unsafe_allow_html=True)
+    """
+
+
+def display_media_message(message, is_sender):
+    """Display a message with media content"""
+    st.markdown(media_message_html(message, is_sender), unsafe_allow_html=True)
+
+
+def text_message_html(message, is_sender):
+    """Build the HTML for a text-only message"""
+    content = escape(message.get("content", ""))
+    timestamp = escape(message.get("timestamp", ""))
+    sender = escape(message.get("sender", ""))
+
+    if is_sender:
+        return f"""
+        <div class="message-row-right">
+            <div class="message-content">
+                <div>{content}</div>
+                <div class="message-time">🕐 {timestamp}</div>
+            </div>
+        </div>
+        """
+
+    sender_name = "Admin" if sender == "admin" else sender
+    return f"""
+    <div class="message-row-left">
+        <div class="message-content">
+            <div><strong>{sender_name}:</strong> {content}</div>
+            <div class="message-time">🕐 {timestamp}</div>
+        </div>
+    </div>
+    """
+
+
+def message_html(message, is_sender):
+    """Return a message's HTML fragment, building it only when the message is new or has changed"""
+    fingerprint = hash(tuple(message.get(field) for field in (
+        "content", "timestamp", "sender", "media_path", "media_type", "original_filename", "media_status",
+        "display_path")))
+    key = (message.get("message_id"), fingerprint, is_sender)
+
+    cache = get_message_html_cache()
+    html = cache.get(key)
+    if html is None:
+        html = media_message_html(message, is_sender) if message.get("media_path") else text_message_html(
+            message, is_sender)
+        # Without indentation or blank lines, fragments can be joined without Markdown reading any as code
+        html = "\n".join(line.strip() for line in html.splitlines() if line.strip())
+        cache.put(key, html)
+    return html
 
 
 def show_login_page():
@@ -340,6 +3395,7 @@ def show_login_page():
                             st.session_state.current_user = username.strip()
                             st.session_state.is_authenticated = True
                             st.session_state.is_admin = is_admin
+                            remember_login()
                             st.success(f"Welcome!, {username}!")
                             time.sleep(1.5)
                             st.rerun()
@@ -384,6 +3440,7 @@ def show_login_page():
                             st.session_state.current_user = st.session_state.temp_username
                             st.session_state.is_authenticated = True
                             st.session_state.is_admin = is_admin
+                            remember_login()
                             st.session_state.admin_login_mode = False
                             st.session_state.temp_username = ""
 
@@ -419,16 +3476,15 @@ def show_admin_inbox():
     st.title("Admin Inbox")
     st.markdown("Manage all user conversations from here")
 
-    # Get all user chats
-    user_chats = get_all_user_chats()
+    inbox_stats = get_inbox_stats()
 
-    if not user_chats:
+    if not inbox_stats["chat_count"]:
         st.info("No user conversations yet. Users will appear here when they start chatting.")
         return
 
     # Stats
-    total_users = len(user_chats)
-    total_unread = sum(chat["unread_count"] for chat in user_chats)
+    total_users = inbox_stats["chat_count"]
+    total_unread = inbox_stats["unread_count"]
 
     col1, col2, col3 = st.columns(3)
     with col1:
@@ -439,8 +3495,41 @@ def show_admin_inbox():
         if st.button("Refresh Inbox"):
             st.rerun()
 
+    search_query = st.text_input("🔍 Search messages", placeholder="Search all conversations...",
+                                 key="inbox_search")
+    if search_query.strip():
+        show_search_results(search_query)
+
     st.markdown("---")
 
+    # Filters; changing any of them starts again from the first page
+    def reset_inbox_page():
+        st.session_state.inbox_page = 0
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        unread_only = st.checkbox("Unread only", key="inbox_unread_only", on_change=reset_inbox_page)
+    with col2:
+        active_label = st.selectbox("Active since", list(INBOX_ACTIVE_SINCE), key="inbox_active_since",
+                                    on_change=reset_inbox_page)
+    with col3:
+        sort = st.selectbox("Sort by", list(INBOX_SORT_ORDERS), key="inbox_sort", on_change=reset_inbox_page)
+
+    active_window = INBOX_ACTIVE_SINCE[active_label]
+    # Whole minutes, so that reruns within a minute share one cached page
+    active_since = ((datetime.now() - active_window).replace(second=0, microsecond=0).isoformat()
+                    if active_window else None)
+    user_chats, matching = get_inbox_page(unread_only, active_since, sort, st.session_state.inbox_page)
+    page_count = max((matching + INBOX_PAGE_SIZE - 1) // INBOX_PAGE_SIZE, 1)
+    if st.session_state.inbox_page >= page_count:
+        # The page ran past the end, for example after conversations were deleted
+        st.session_state.inbox_page = page_count - 1
+        user_chats, matching = get_inbox_page(unread_only, active_since, sort, st.session_state.inbox_page)
+
+    if not user_chats:
+        st.info("No conversations match these filters.")
+        return
+
     # User list
     for chat in user_chats:
         user_id = chat["user_id"]
@@ -487,6 +3576,7 @@ def show_admin_inbox():
                 if st.button("💬 Open", key=f"open_{user_id}"):
                     st.session_state.selected_user_chat = user_id
                     st.session_state.admin_view_mode = "chat"
+                    st.session_state.highlight_message = None
                     # Mark messages as read when admin opens chat
                     mark_messages_as_read(user_id)
                     st.rerun()
@@ -499,6 +3589,75 @@ def show_admin_inbox():
 
         st.divider()
 
+    # Pager
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("◀ Previous", disabled=st.session_state.inbox_page == 0, use_container_width=True):
+            st.session_state.inbox_page -= 1
+            st.rerun()
+    with col2:
+        first = st.session_state.inbox_page * INBOX_PAGE_SIZE + 1
+        st.caption(f"Page {st.session_state.inbox_page + 1} of {page_count} • "
+                   f"conversations {first}–{first + len(user_chats) - 1} of {matching}")
+    with col3:
+        if st.button("Next ▶", disabled=st.session_state.inbox_page + 1 >= page_count, use_container_width=True):
+            st.session_state.inbox_page += 1
+            st.rerun()
+
+
+def show_search_results(query):
+    """Show ranked search hits, each with a button that opens the chat at that message"""
+    started = time.perf_counter()
+    hits = search_messages(query)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    if not hits:
+        st.caption(f"No messages match “{query}”")
+        return
+    st.caption(f"{len(hits)} best matches in {elapsed_ms:.0f} ms")
+
+    for hit in hits:
+        col1, col2 = st.columns([5, 1])
+        with col1:
+            sender_label = "You" if hit["sender"] == "admin" else hit["sender"]
+            st.markdown(f"**👤 {hit['user_id']}** · {sender_label} · 🕐 {hit['timestamp']}")
+            st.caption(hit["snippet"] or f"📎 {hit['original_filename']}")
+        with col2:
+            if st.button("↪ Jump", key=f"jump_{hit['user_id']}_{hit['seq']}"):
+                st.session_state.selected_user_chat = hit["user_id"]
+                st.session_state.admin_view_mode = "chat"
+                st.session_state.highlight_message = {"user_id": hit["user_id"], "seq": hit["seq"]}
+                mark_messages_as_read(hit["user_id"])
+                st.rerun()
+
+
+def show_retention_controls(user_id):
+    """Let the admin see how much of a chat is archived and change how long its history is kept"""
+    policy = get_retention_policy(user_id)
+    if policy is None:
+        return
+
+    with st.expander("🗄️ History retention"):
+        if policy["segments"]:
+            st.caption(f"{policy['messages']} older messages archived in {policy['segments']} segments "
+                       f"({policy['bytes'] / 1024:.0f} KB compressed)")
+        else:
+            st.caption("Nothing archived yet")
+
+        with st.form(f"retention_{user_id}"):
+            hot_messages = st.number_input("Messages kept unarchived", min_value=CHAT_PAGE_SIZE,
+                                           value=policy["hot_messages"], step=CHAT_PAGE_SIZE)
+            labels = list(CHAT_RETENTION_OPTIONS)
+            days = list(CHAT_RETENTION_OPTIONS.values())
+            retention = st.selectbox("Keep archived messages for", labels,
+                                     index=days.index(policy["retention_days"])
+                                     if policy["retention_days"] in days else 0)
+            if st.form_submit_button("Save"):
+                if set_retention_policy(user_id, int(hot_messages), CHAT_RETENTION_OPTIONS[retention]):
+                    st.success("Retention policy saved")
+                else:
+                    st.error("Failed to save the retention policy")
+
 
 def show_admin_chat_view():
     """Show admin chat interface with specific user"""
@@ -521,11 +3680,23 @@ def show_admin_chat_view():
             st.session_state.selected_user_chat = None
             st.rerun()
 
+    show_retention_controls(user_id)
+
     # Load messages
-    messages = load_private_chat(user_id)
+    messages, older_cursor = load_chat_history(user_id)
+
+    # A message opened from search is loaded even when it is older than the first page, and highlighted
+    highlight = st.session_state.highlight_message
+    highlight_seq = highlight["seq"] if highlight and highlight["user_id"] == user_id else None
+    if highlight_seq is not None:
+        extend_chat_history(user_id, highlight_seq)
+        cache = st.session_state.chat_cache
+        messages, older_cursor = cache["messages"], cache["older_cursor"]
+        st.markdown(f"🔍 Showing a message found by search. [Jump to it](#message-{highlight_seq})")
 
     # Display messages
-    show_chat_messages(messages, "admin")
+    show_load_older_button(user_id, older_cursor)
+    show_chat_messages(messages, "admin", user_id, highlight_seq)
 
     # Admin input section
     show_admin_input_section(user_id)
@@ -540,50 +3711,44 @@ def show_user_chat_view():
     st.markdown("---")
 
     # Load messages
-    messages = load_private_chat(user_id)
+    messages, older_cursor = load_chat_history(user_id)
 
     # Display messages
-    show_chat_messages(messages, user_id)
+    show_load_older_button(user_id, older_cursor)
+    show_chat_messages(messages, user_id, user_id)
 
     # User input section
     show_user_input_section()
 
 
-def show_chat_messages(messages, current_user_id):
-    if messages:
-        st.markdown('<div class="chat-container">', unsafe_allow_html=True)
+def needs_streamlit_player(message):
+    """Check whether a video message has no media server URL and is played with st.video instead"""
+    media_path = message.get("media_path")
+    return (message.get("media_type") == "video" and bool(media_path) and media_url("media", media_path) is None
+            and os.path.exists(media_path))
+
 
-        for message in messages[-50:]:
+def show_chat_messages(messages, current_user_id, chat_user_id, highlight_seq=None):
+    if messages:
+        fragments = []
+        for message in messages:
+            schedule_media_processing(chat_user_id, message)
             sender = message.get("sender", "")
             is_sender = (sender == current_user_id) or (current_user_id == "admin" and sender == "admin")
-
-            if message.get("media_path"):
-                display_media_message(message, is_sender)
-            else:
-                content = message.get("content", "")
-                timestamp = message.get("timestamp", "")
-
-                if is_sender:
-                    st.markdown(f"""
-                    <div class="message-row-right">
-                        <div class="message-content">
-                            <div>{content}</div>
-                            <div class="message-time">🕐 {timestamp}</div>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                else:
-                    sender_name = "Admin" if sender == "admin" else sender
-                    st.markdown(f"""
-                    <div class="message-row-left">
-                        <div class="message-content">
-                            <div><strong>{sender_name}:</strong> {content}</div>
-                            <div class="message-time">🕐 {timestamp}</div>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-
-        st.markdown('</div>', unsafe_allow_html=True)
+            fragment = message_html(message, is_sender)
+            if message.get("seq") == highlight_seq:
+                fragment = (f'<div id="message-{highlight_seq}" '
+                            f'style="outline: 2px solid #f5c518; border-radius: 12px;">{fragment}</div>')
+            fragments.append(fragment)
+            if needs_streamlit_player(message):
+                # Without a media server URL, Streamlit's own media endpoint streams the video, with Range requests
+                st.markdown("\n".join(fragments), unsafe_allow_html=True)
+                fragments = []
+                st.video(message["media_path"])
+
+        # The whole history goes to the browser as a single element, split only around such videos
+        if fragments:
+            st.markdown("\n".join(fragments), unsafe_allow_html=True)
     else:
         st.markdown("""
         <div style="text-align: center; padding: 40px 20px; background: rgba(0,0,0,0.05); border-radius: 10px; margin: 20px 0; border: 1px solid #333;">
@@ -593,13 +3758,6 @@ def show_chat_messages(messages, current_user_id):
         </div>
         """, unsafe_allow_html=True)
 
-    current_time = time.time()
-    time_since_last_refresh = current_time - st.session_state.last_refresh
-
-    if st.session_state.auto_refresh_enabled and time_since_last_refresh >= st.session_state.auto_refresh_time:
-        st.session_state.last_refresh = current_time
-        st.rerun()
-
 
 def show_user_input_section():
     """Show input section for regular users"""
@@ -614,27 +3772,30 @@ def show_user_input_section():
         with col1:
             uploaded_file = st.file_uploader(
                 "Choose an image or video file",
-                type=['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'mp4', 'avi', 'mov', 'wmv', 'flv', 'webm', 'mkv'],
+                type=UPLOAD_TYPES,
                 help="Supported formats: Images (JPG, PNG, GIF, etc.) and Videos (MP4, AVI, MOV, etc.)"
             )
         with col2:
             media_caption = st.text_area("Caption (optional)", height=100, placeholder="Add a caption...")
 
         if uploaded_file is not None:
-            file_size_mb = len(uploaded_file.getbuffer()) / (1024 * 1024)
-            st.info(f"📄 **{uploaded_file.name}** • {file_size_mb:.1f} MB")
+            st.info(f"📄 **{uploaded_file.name}** • {uploaded_file.size / (1024 * 1024):.1f} MB")
+            upload = stage_upload(uploaded_file)
 
-            if file_size_mb > 50:
-                st.error("❌ File too large! choose a file smaller than 50MB.")
+            if upload["error"]:
+                st.error(f"❌ {upload['error']}")
             else:
                 col1, col2 = st.columns([1, 1])
                 with col1:
                     if st.button("📤 Send", type="primary"):
                         message_id = str(uuid4())
-                        media_path = save_media_file(uploaded_file, message_id)
+                        media_path = commit_upload(upload)
+                        st.session_state.staged_upload = None
 
                         if media_path:
-                            media_type = "image" if is_image_file(uploaded_file.name) else "video"
+                            media_type = upload["media_type"]
+                            # Images are shown once a media worker has processed them
+                            media_status = "processing" if media_type == "image" else "ready"
 
                             user_message = {
                                 "message_id": message_id,
@@ -643,20 +3804,28 @@ def show_user_input_section():
                                 "sender": user_id,
                                 "media_path": media_path,
                                 "media_type": media_type,
+                                "media_sha256": upload["sha256"],
+                                "media_status": media_status,
                                 "original_filename": uploaded_file.name
                             }
 
-                            save_private_chat_message(user_id, user_message)
-                            st.session_state.show_media_uploader = False
-                            st.success("✅ Media sent!")
-                            st.rerun()
+                            if save_private_chat_message(user_id, user_message):
+                                schedule_media_processing(user_id, user_message)
+                                st.session_state.show_media_uploader = False
+                                st.success("✅ Media sent!")
+                                st.rerun()
+                            else:
+                                st.error("Failed to send media, please try again!")
                         else:
                             st.error("Failed to save media file!")
 
                 with col2:
                     if st.button("Cancel"):
+                        discard_staged_upload()
                         st.session_state.show_media_uploader = False
                         st.rerun()
+        elif st.session_state.staged_upload:
+            discard_staged_upload()
 
         st.markdown('</div>', unsafe_allow_html=True)
 
@@ -671,8 +3840,10 @@ def show_user_input_section():
                 "sender": user_id
             }
 
-            save_private_chat_message(user_id, message)
-            st.rerun()
+            if save_private_chat_message(user_id, message):
+                st.rerun()
+            else:
+                st.error("Failed to send message, please try again!")
 
     with col2:
         if st.button("📎 Media", use_container_width=True, help="Send images or videos"):
@@ -691,7 +3862,7 @@ def show_admin_input_section(target_user_id):
         with col1:
             uploaded_file = st.file_uploader(
                 "Choose an image or video file",
-                type=['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'mp4', 'avi', 'mov', 'wmv', 'flv', 'webm', 'mkv'],
+                type=UPLOAD_TYPES,
                 help="Supported formats: Images (JPG, PNG, GIF, etc.) and Videos (MP4, AVI, MOV, etc.)",
                 key="admin_media_upload"
             )
@@ -700,20 +3871,23 @@ def show_admin_input_section(target_user_id):
                                          key="admin_caption")
 
         if uploaded_file is not None:
-            file_size_mb = len(uploaded_file.getbuffer()) / (1024 * 1024)
-            st.info(f"📄 **{uploaded_file.name}** • {file_size_mb:.1f} MB")
+            st.info(f"📄 **{uploaded_file.name}** • {uploaded_file.size / (1024 * 1024):.1f} MB")
+            upload = stage_upload(uploaded_file)
 
-            if file_size_mb > 50:
-                st.error("File too large! Please choose a file smaller than 50MB.")
+            if upload["error"]:
+                st.error(upload["error"])
             else:
                 col1, col2 = st.columns([1, 1])
                 with col1:
                     if st.button("📤 Send to User", type="primary", key="admin_send_media"):
                         message_id = str(uuid4())
-                        media_path = save_media_file(uploaded_file, message_id)
+                        media_path = commit_upload(upload)
+                        st.session_state.staged_upload = None
 
                         if media_path:
-                            media_type = "image" if is_image_file(uploaded_file.name) else "video"
+                            media_type = upload["media_type"]
+                            # Images are shown once a media worker has processed them
+                            media_status = "processing" if media_type == "image" else "ready"
 
                             admin_message = {
                                 "message_id": message_id,
@@ -722,20 +3896,28 @@ def show_admin_input_section(target_user_id):
                                 "sender": "admin",
                                 "media_path": media_path,
                                 "media_type": media_type,
+                                "media_sha256": upload["sha256"],
+                                "media_status": media_status,
                                 "original_filename": uploaded_file.name
                             }
 
-                            save_private_chat_message(target_user_id, admin_message)
-                            st.session_state.show_media_uploader = False
-                            st.success(f"Media sent to {target_user_id}!")
-                            st.rerun()
+                            if save_private_chat_message(target_user_id, admin_message):
+                                schedule_media_processing(target_user_id, admin_message)
+                                st.session_state.show_media_uploader = False
+                                st.success(f"Media sent to {target_user_id}!")
+                                st.rerun()
+                            else:
+                                st.error("Failed to send media, please try again!")
                         else:
                             st.error("Failed to save media file!")
 
                 with col2:
                     if st.button("Cancel", key="admin_cancel_media"):
+                        discard_staged_upload()
                         st.session_state.show_media_uploader = False
                         st.rerun()
+        elif st.session_state.staged_upload:
+            discard_staged_upload()
 
         st.markdown('</div>', unsafe_allow_html=True)
 
@@ -751,8 +3933,10 @@ def show_admin_input_section(target_user_id):
                 "sender": "admin"
             }
 
-            save_private_chat_message(target_user_id, message)
-            st.rerun()
+            if save_private_chat_message(target_user_id, message):
+                st.rerun()
+            else:
+                st.error("Failed to send message, please try again!")
 
     with col2:
         if st.button("📎 Media", use_container_width=True, help="Send images or videos", key="admin_media_toggle"):
@@ -760,8 +3944,118 @@ def show_admin_input_section(target_user_id):
             st.rerun()
 
 
+def show_profiling_controls():
+    """Let the admin profile their next reruns and show the slowest functions of the last profile"""
+    st.markdown("### 🔬 Profiling")
+    profile = st.session_state.profile
+    if profile:
+        st.caption(f"{profile['mode']}: profiling {profile['reruns_left']} more rerun(s)")
+        if st.button("⏹ Stop profiling", use_container_width=True):
+            profile["reruns_left"] = 1
+            st.rerun()
+    else:
+        mode = st.selectbox("Profiler:", PROFILE_MODES, help="cProfile counts every call; sampling has less overhead")
+        reruns = st.number_input("Reruns to profile:", 1, PROFILE_MAX_RERUNS, 3)
+        if st.button("▶️ Start profiling", use_container_width=True):
+            start_profiling(mode, int(reruns))
+            st.rerun()
+
+    last_profile = st.session_state.last_profile
+    if last_profile:
+        with st.expander(f"Last profile: {last_profile['mode']}, {last_profile['reruns']} rerun(s)"):
+            if last_profile["path"]:
+                st.caption(f"Saved to {last_profile['path']}")
+            else:
+                st.caption("Could not save the profile")
+            st.dataframe(last_profile["top"], use_container_width=True, hide_index=True)
+
+
+def show_sidebar():
+    """Show the sidebar with the user's info, and for the admin, the controls and stats"""
+    with st.sidebar:
+        st.markdown("### 👤 User Info")
+        st.write(f"**Username:** {st.session_state.current_user}")
+        st.write(f"**Role:** {'Admin' if st.session_state.is_admin else 'User'}")
+
+        st.markdown("---")
+
+        if st.session_state.is_admin:
+            st.markdown("### 🛠 Admin Controls")
+
+            view_options = ["📧 Inbox", "💬 Chat View"] if st.session_state.selected_user_chat else ["📧 Inbox"]
+            current_view = "📧 Inbox" if st.session_state.admin_view_mode == "inbox" else "💬 Chat View"
+
+            selected_view = st.selectbox("View Mode:", view_options, index=view_options.index(current_view))
+
+            if selected_view == "📧 Inbox" and st.session_state.admin_view_mode != "inbox":
+                st.session_state.admin_view_mode = "inbox"
+                st.session_state.selected_user_chat = None
+                st.rerun()
+
+            st.markdown("### ⏰ Auto Refresh")
+            st.session_state.auto_refresh_enabled = st.checkbox("Auto-refresh enabled",
+                                                                st.session_state.auto_refresh_enabled)
+            new_refresh_time = st.slider("Refresh interval (seconds):", 1, 30, st.session_state.auto_refresh_time)
+            if new_refresh_time != st.session_state.auto_refresh_time:
+                st.session_state.auto_refresh_time = new_refresh_time
+
+            inbox_stats = get_inbox_stats()
+
+            st.markdown("### 📊 Quick Stats")
+            st.metric("Active Users", inbox_stats["chat_count"])
+            st.metric("Unread Messages", inbox_stats["unread_count"])
+
+            media_usage = get_media_usage()
+            if media_usage:
+                st.markdown("### 💾 Media Storage")
+                st.metric("Stored Media", f"{media_usage['total_bytes'] / (1024 * 1024):.1f} MB",
+                          help=f"{media_usage['total_files']} files")
+                if media_usage["unreferenced_bytes"]:
+                    st.caption(f"🧹 {media_usage['unreferenced_bytes'] / (1024 * 1024):.1f} MB no longer used, "
+                               f"awaiting cleanup")
+                for usage in media_usage["users"]:
+                    st.caption(f"👤 {usage['user_id']}: {usage['bytes'] / (1024 * 1024):.1f} MB "
+                               f"in {usage['files']} files")
+
+            show_profiling_controls()
+
+        else:
+            st.markdown("### 💬 Chat Info")
+            st.info("You are chatting privately")
+            st.markdown("🟢 Online")
+
+        st.markdown("---")
+
+        if st.button("🚪 Logout", use_container_width=True):
+            forget_login()
+            for key in list(st.session_state.keys()):
+                del st.session_state[key]
+            st.success("Logged out successfully!")
+            time.sleep(1)
+            st.rerun()
+
+
+def show_current_view():
+    """Show the admin's inbox or chat, or the user's chat"""
+    if st.session_state.is_admin:
+        if st.session_state.admin_view_mode == "inbox":
+            show_admin_inbox()
+        elif st.session_state.admin_view_mode == "chat" and st.session_state.selected_user_chat:
+            show_admin_chat_view()
+        else:
+            show_admin_inbox()
+    else:
+        show_user_chat_view()
+
+
 def main():
+    rerun_started = time.perf_counter()
+    start_change_feed()
     initialize_session()
+    start_media_server()
+    start_media_collector()
+    start_chat_archiver()
+    start_metrics_textfile()
 
     st.markdown("""
     <style>
@@ -840,70 +4134,27 @@ def main():
 
     if not st.session_state.is_authenticated:
         show_login_page()
+        observe_span("rerun", rerun_started)
         return
 
-    with st.sidebar:
-        st.markdown("### 👤 User Info")
-        st.write(f"**Username:** {st.session_state.current_user}")
-        st.write(f"**Role:** {'Admin' if st.session_state.is_admin else 'User'}")
-
-        st.markdown("---")
+    # Any rerun not caused by the idle timer means the session is active again
+    if not st.session_state.idle_rerun:
+        st.session_state.idle_refresh_interval = st.session_state.auto_refresh_time
+    st.session_state.idle_rerun = False
 
-        if st.session_state.is_admin:
-            st.markdown("### 🛠 Admin Controls")
+    # Taken before any data is read so that a write during this run still triggers the next one
+    seen_versions = get_change_notifier().snapshot(watched_change_keys())
 
-            view_options = ["📧 Inbox", "💬 Chat View"] if st.session_state.selected_user_chat else ["📧 Inbox"]
-            current_view = "📧 Inbox" if st.session_state.admin_view_mode == "inbox" else "💬 Chat View"
+    with profile_rerun():
+        show_sidebar()
+        show_current_view()
 
-            selected_view = st.selectbox("View Mode:", view_options, index=view_options.index(current_view))
-
-            if selected_view == "📧 Inbox" and st.session_state.admin_view_mode != "inbox":
-                st.session_state.admin_view_mode = "inbox"
-                st.session_state.selected_user_chat = None
-                st.rerun()
-
-            st.markdown("### ⏰ Auto Refresh")
-            st.session_state.auto_refresh_enabled = st.checkbox("Auto-refresh enabled",
-                                                                st.session_state.auto_refresh_enabled)
-            new_refresh_time = st.slider("Refresh interval (seconds):", 1, 30, st.session_state.auto_refresh_time)
-            if new_refresh_time != st.session_state.auto_refresh_time:
-                st.session_state.auto_refresh_time = new_refresh_time
-
-            user_chats = get_all_user_chats()
-            total_unread = sum(chat["unread_count"] for chat in user_chats)
-
-            st.markdown("### 📊 Quick Stats")
-            st.metric("Active Users", len(user_chats))
-            st.metric("Unread Messages", total_unread)
-
-        else:
-            st.markdown("### 💬 Chat Info")
-            st.info("You are chatting privately")
-            st.markdown("🟢 Online")
-
-        st.markdown("---")
-
-        if st.button("🚪 Logout", use_container_width=True):
-            for key in list(st.session_state.keys()):
-                del st.session_state[key]
-            st.success("Logged out successfully!")
-            time.sleep(1)
-            st.rerun()
-
-    if st.session_state.is_admin:
-        if st.session_state.admin_view_mode == "inbox":
-            show_admin_inbox()
-        elif st.session_state.admin_view_mode == "chat" and st.session_state.selected_user_chat:
-            show_admin_chat_view()
-        else:
-            show_admin_inbox()
-    else:
-        show_user_chat_view()
+    # Measured before waiting for changes, which is idle time rather than work
+    observe_span("rerun", rerun_started)
 
     # Auto-refresh logic - always enabled for users, admin controlled for admins
     if st.session_state.auto_refresh_enabled or not st.session_state.is_admin:
-        time.sleep(st.session_state.auto_refresh_time)
-        st.rerun()
+        wait_for_changes(seen_versions)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,243 @@
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import gc6
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Small pages and segments, so that paging and archiving are exercised with a few dozen messages
+    monkeypatch.setattr(gc6, "CHAT_PAGE_SIZE", 5)
+    monkeypatch.setattr(gc6, "CHAT_ARCHIVE_SEGMENT_MESSAGES", 10)
+    if request.param == "json":
+        return gc6.JsonChatStore(str(tmp_path / "chats"), str(tmp_path / "index.db"), str(tmp_path / "archive"))
+    return gc6.SqliteChatStore(str(tmp_path / "chats.db"), str(tmp_path / "archive"))
+
+
+def make_message(number, sender="alice", **fields):
+    return {"message_id": f"m{number}", "sender": sender, "content": f"message {number}",
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), **fields}
+
+
+def append_messages(store, user_id, count, sender="alice", media=None):
+    """Append count messages in one batch; media maps a message number to the file it references"""
+    media = media or {}
+    errors = store.apply_batch([
+        ("append", user_id, make_message(number, sender, **({"media_path": media[number]} if number in media else {})))
+        for number in range(1, count + 1)])
+    assert errors == [None] * count
+
+
+def make_media_file(tmp_path, name, size):
+    path = tmp_path / "media" / name
+    path.parent.mkdir(exist_ok=True)
+    path.write_bytes(b"x" * size)
+    return str(path)
+
+
+def unread_count(store, user_id):
+    return next(chat["unread_count"] for chat in store.list_chats() if chat["user_id"] == user_id)
+
+
+def media_refcount(store, media_path):
+    row = store._index_db().execute("SELECT refcount FROM media_files WHERE media_path = ?", (media_path,)).fetchone()
+    return row["refcount"] if row else None
+
+
+def media_usage(store):
+    return {user["user_id"]: (user["bytes"], user["files"]) for user in store.media_usage()["users"]}
+
+
+def test_append_and_load_page_cursors(store):
+    append_messages(store, "alice", 12)
+
+    messages, cursor = store.load_page("alice", limit=5)
+    assert [message["seq"] for message in messages] == [8, 9, 10, 11, 12]
+    assert cursor == 8
+    messages, cursor = store.load_page("alice", before_seq=cursor, limit=5)
+    assert [message["seq"] for message in messages] == [3, 4, 5, 6, 7]
+    messages, cursor = store.load_page("alice", before_seq=cursor, limit=5)
+    assert [message["seq"] for message in messages] == [1, 2]
+    assert cursor is None
+
+    messages, _ = store.load_page("alice", after_seq=10, limit=None)
+    assert [message["message_id"] for message in messages] == ["m11", "m12"]
+    assert store.load_page("nobody", limit=5) == ([], None)
+
+
+def test_update_merges_fields(store):
+    append_messages(store, "alice", 2)
+    store.update_message("alice", "m1", {"content": "edited"})
+    messages = store.load_messages("alice")
+    assert [message["content"] for message in messages] == ["edited", "message 2"]
+
+
+def test_mark_read_watermark(store):
+    append_messages(store, "alice", 3)
+    store.append_message("alice", make_message(4, sender="admin"))
+    assert unread_count(store, "alice") == 3
+
+    store.mark_read("alice")
+    assert unread_count(store, "alice") == 0
+    store.append_message("alice", make_message(5))
+    assert unread_count(store, "alice") == 1
+
+
+def test_clear(store, tmp_path):
+    media_path = make_media_file(tmp_path, "a.jpg", 100)
+    append_messages(store, "alice", 3, media={2: media_path})
+    append_messages(store, "bob", 1)
+    store.clear_chat("alice")
+
+    assert store.load_messages("alice") == []
+    assert store.load_page("alice", limit=5) == ([], None)
+    assert len(store.load_messages("bob")) == 1
+    assert media_refcount(store, media_path) == 0
+    assert "alice" not in media_usage(store)
+
+    store.append_message("alice", make_message(1))
+    assert [message["message_id"] for message in store.load_messages("alice")] == ["m1"]
+
+
+def test_media_refcounts(store, tmp_path):
+    shared_path = make_media_file(tmp_path, "shared.jpg", 100)
+    own_path = make_media_file(tmp_path, "own.jpg", 1000)
+    append_messages(store, "alice", 2, media={1: shared_path, 2: own_path})
+    append_messages(store, "bob", 1, media={1: shared_path})
+
+    assert media_refcount(store, shared_path) == 2
+    assert media_refcount(store, own_path) == 1
+    assert media_usage(store) == {"alice": (1100, 2), "bob": (100, 1)}
+
+    store.clear_chat("bob")
+    assert media_refcount(store, shared_path) == 1
+    assert media_usage(store) == {"alice": (1100, 2)}
+
+    with pytest.raises(FileNotFoundError):
+        store.append_message("bob", make_message(2, media_path=str(tmp_path / "media" / "missing.jpg")))
+
+
+def test_archive_paging_and_expiry(store, tmp_path):
+    old_path = make_media_file(tmp_path, "old.jpg", 100)
+    new_path = make_media_file(tmp_path, "new.jpg", 1000)
+    append_messages(store, "alice", 30, media={3: old_path, 25: new_path})
+    store.set_retention_policy("alice", hot_messages=5, retention_days=30)
+
+    assert store.archive_chat("alice") == 20
+    assert store.archive_stats("alice")["messages"] == 20
+    assert [message["seq"] for message in store.load_messages("alice")] == list(range(1, 31))
+
+    seqs, cursor = [], None
+    while True:
+        messages, cursor = store.load_page("alice", before_seq=cursor, limit=7)
+        seqs = [message["seq"] for message in messages] + seqs
+        if cursor is None:
+            break
+    assert seqs == list(range(1, 31))
+
+    # Only the oldest segment is past its retention period
+    store._index_db().execute("UPDATE archive_segments SET last_at = '2000-01-01' WHERE user_id = ? AND first_seq = 1",
+                              ("alice",))
+    assert store.expire_archives() == {"alice": 10}
+    assert [message["seq"] for message in store.load_messages("alice")] == list(range(11, 31))
+    assert store.archive_stats("alice")["messages"] == 10
+    assert media_refcount(store, old_path) == 0
+    assert media_refcount(store, new_path) == 1
+    assert media_usage(store) == {"alice": (1000, 1)}
+
+
+def test_json_legacy_chat_migration(tmp_path):
+    root = tmp_path / "chats"
+    root.mkdir()
+    messages = [make_message(1, read_by_admin=True), make_message(2, sender="admin"),
+                make_message(3, read_by_admin=False), make_message(4)]
+    (root / "alice.json").write_text(json.dumps({
+        "user_id": "alice", "created_at": "2024-01-01T00:00:00", "last_updated": "2024-01-02T00:00:00",
+        "messages": messages}), encoding="utf-8")
+
+    store = gc6.JsonChatStore(str(root), str(tmp_path / "index.db"), str(tmp_path / "archive"))
+    assert [message["message_id"] for message in store.load_messages("alice")] == ["m1", "m2", "m3", "m4"]
+    assert unread_count(store, "alice") == 2
+    assert not (root / "alice.json").exists()
+    assert os.path.exists(store.chat_path("alice"))
+
+
+def test_sqlite_read_flag_migration(tmp_path):
+    db_path = str(tmp_path / "chats.db")
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE chats (user_id TEXT PRIMARY KEY, created_at TEXT NOT NULL, last_updated TEXT NOT NULL);
+        CREATE TABLE messages (
+            user_id TEXT NOT NULL, seq INTEGER NOT NULL, message_id TEXT, sender TEXT,
+            read_by_admin INTEGER NOT NULL DEFAULT 0, created_at TEXT NOT NULL, payload TEXT NOT NULL,
+            PRIMARY KEY (user_id, seq)
+        );
+    """)
+    conn.execute("INSERT INTO chats VALUES ('alice', '2024-01-01T00:00:00', '2024-01-02T00:00:00')")
+    for seq, (sender, read) in enumerate([("alice", 1), ("admin", 0), ("alice", 0), ("alice", 0)], start=1):
+        message = make_message(seq, sender=sender)
+        conn.execute("INSERT INTO messages VALUES ('alice', ?, ?, ?, ?, '2024-01-02T00:00:00', ?)",
+                     (seq, message["message_id"], sender, read, json.dumps(message)))
+    conn.commit()
+    conn.close()
+
+    store = gc6.SqliteChatStore(db_path, str(tmp_path / "archive"))
+    assert [message["message_id"] for message in store.load_messages("alice")] == ["m1", "m2", "m3", "m4"]
+    assert unread_count(store, "alice") == 2
+
+
+def test_json_append_after_torn_record(tmp_path):
+    store = gc6.JsonChatStore(str(tmp_path / "chats"), str(tmp_path / "index.db"), str(tmp_path / "archive"))
+    append_messages(store, "alice", 3)
+    with open(store.chat_path("alice"), "ab") as f:
+        f.write(b'{"op":"message","seq":4,"at":"2024-01-')
+
+    store.append_message("alice", make_message(4))
+    store.append_message("alice", make_message(5))
+    messages = store.load_messages("alice")
+    assert [(message["seq"], message["message_id"]) for message in messages] == [
+        (1, "m1"), (2, "m2"), (3, "m3"), (4, "m4"), (5, "m5")]
+    assert store.list_chats()[0]["message_count"] == 5
+
+
+def test_bad_operation_fails_alone(store, tmp_path):
+    missing_path = str(tmp_path / "media" / "missing.jpg")
+    results = store.apply_batch([("append", "alice", make_message(1)),
+                                 ("append", "alice", make_message(2, media_path=missing_path)),
+                                 ("append", "bob", make_message(3)),
+                                 ("append", "alice", make_message(4))])
+    assert results[0] is None and results[2] is None and results[3] is None
+    assert isinstance(results[1], FileNotFoundError)
+    assert [message["message_id"] for message in store.load_messages("alice")] == ["m1", "m4"]
+    assert [message["message_id"] for message in store.load_messages("bob")] == ["m3"]
+
+
+def test_session_token_rotation(store):
+    token = store.create_session("Ariyan", True)
+    new_token, user_id, is_admin = store.rotate_session(token)
+    assert (user_id, is_admin) == ("Ariyan", True)
+    assert store.resume_session(token) is None
+    assert store.rotate_session(token) is None
+    assert store.resume_session(new_token) == ("Ariyan", True)
+
+
+def test_expiry_skips_bad_segments(store):
+    for user_id in ("alice", "bob", "carol"):
+        append_messages(store, user_id, 20)
+        store.set_retention_policy(user_id, hot_messages=5, retention_days=30)
+        assert store.archive_chat(user_id) == 10
+    store._index_db().execute("UPDATE archive_segments SET last_at = '2000-01-01'")
+    segments = {row["user_id"]: f"{store._archive_path(row['user_id'])}/{row['file_name']}"
+                for row in store._index_db().execute("SELECT user_id, file_name FROM archive_segments")}
+    os.remove(segments["alice"])
+    with open(segments["bob"], "wb") as f:
+        f.write(b"not a segment")
+
+    assert store.expire_archives() == {"alice": 10, "carol": 10}
+    assert store.archive_stats("bob")["messages"] == 10
+    assert [message["seq"] for message in store.load_messages("carol")] == list(range(11, 21))
@@ -0,0 +1,29 @@
+import pytest
+
+import gc6
+
+
+@pytest.mark.parametrize("range_header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-199", (100, 199)),
+    ("bytes=900-", (900, 999)),
+    ("bytes=0-", (0, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+])
+def test_parse_byte_range(range_header, expected):
+    assert gc6._parse_byte_range(range_header, 1000) == expected
+
+
+@pytest.mark.parametrize("range_header", [
+    "bytes=1000-",
+    "bytes=500-100",
+    "bytes=-0",
+    "bytes=a-b",
+    "bytes=0-1,5-9",
+    "items=0-99",
+    "bytes=",
+])
+def test_parse_byte_range_unsatisfiable(range_header):
+    assert gc6._parse_byte_range(range_header, 1000) is None